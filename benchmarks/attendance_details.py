@@ -0,0 +1,91 @@
+"""Per-session cost of Course.get_attendance_details as a course grows.
+
+Seeds a course with more and more attendance windows (the student attended
+every other one) and times get_attendance_details. With the join done on a
+set, the cost per session should stay flat as sessions grow into the
+thousands.
+
+Run from the repository root against the Datastore emulator:
+
+    export DATASTORE_EMULATOR_HOST=localhost:8081
+    python -m benchmarks.attendance_details 10 100 1000 3000
+"""
+
+import sys
+import time
+
+import config
+from datetime import datetime, timedelta
+from google.cloud import datastore
+from models import consistency, courses_model, students_model
+
+
+REPEATS = 5
+
+# waits for the seeded windows to show up in queries, whatever strategy the
+# app itself is configured with, and gives up on a size after the deadline
+_seeded = consistency.WriteConfirmer(
+    consistency.BACKOFF, deadline=config.WRITE_CONFIRMATION_DEADLINE)
+
+
+def seed(course, student, sessions):
+    client = course.datastore
+    start = datetime(2017, 1, 1)
+    windows = list()
+    for i in range(sessions):
+        window = datastore.Entity(key=client.key('attendance_window'))
+        window.update({
+            'course_id': course.get_id(),
+            'opened_at': start + timedelta(hours=i),
+            'closed_at': start + timedelta(hours=i, minutes=10),
+            'secret': 1234
+        })
+        windows.append(window)
+    for i in range(0, len(windows), 500):
+        client.put_multi(windows[i:i + 500])
+
+    course.create_entities('attendance_record', [{
+        'attendance_window_id': window.key.id,
+        'user_id': student.get_id(),
+        'course_id': course.get_id()
+    } for window in windows[::2]])
+
+
+def measure(sessions):
+    student = students_model.Student(
+        name='Benchmark Student', email='bench@example.com').get_or_create()
+    student.update(uni='bench' + str(sessions))
+    course = courses_model.Course(name='Benchmark ' + str(sessions)).get_or_create()
+    try:
+        course.add_student(student)
+        seed(course, student, sessions)
+        _seeded.confirm(
+            'seed_attendance', lambda: len(course.get_attendance_details(student)) >= sessions)
+
+        started = time.time()
+        for _ in range(REPEATS):
+            course.get_attendance_details(student)
+        return (time.time() - started) / REPEATS
+    finally:
+        course.destroy()
+        student.destroy()
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [10, 100, 1000]
+    print '{0:>10} {1:>12} {2:>16}'.format('sessions', 'ms/call', 'us/session')
+    failed = 0
+    for sessions in sizes:
+        try:
+            elapsed = measure(sessions)
+        except consistency.WriteConfirmationTimeout as e:
+            print '{0:>10} failed: {1}'.format(sessions, e)
+            failed += 1
+            continue
+        print '{0:>10} {1:>12.1f} {2:>16.1f}'.format(
+            sessions, elapsed * 1000, elapsed * 1e6 / sessions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,345 @@
+"""Offline load test of the Flask routes on the in-memory backend.
+
+Seeds synthetic courses, students, sessions and attendance, then drives
+imhere.app through the Flask test client for each scenario and reports
+throughput, latency percentiles and storage calls per request. No project or
+emulator is needed, so the numbers reflect the app's own work and how many
+storage calls it makes, not network latency.
+
+Every run is saved as JSON under benchmarks/results/ so runs can be compared:
+
+    python -m benchmarks.routes --courses 20 --students 200 --sessions 20
+    python -m benchmarks.routes --scenario view_course --scenario records
+    python -m benchmarks.routes --compare benchmarks/results/a.json benchmarks/results/b.json
+
+The default scale keeps the whole data set in memory comfortably. The full
+scale (100 courses of 500 students with 40 sessions each) is two million
+attendance records and needs a few GB of memory.
+"""
+
+import os
+
+# the harness always runs offline unless told otherwise
+os.environ.setdefault('DATA_BACKEND', 'memory')
+
+import argparse
+import json
+import random
+import sys
+import time
+import urlparse
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from imhere import imhere, jobs
+from models import courses_model, instrumentation, memory_backend, teachers_model, users_model
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+SCENARIOS = ('home', 'view_course', 'sign_in_burst', 'bulk_roster_add', 'records', 'destroy')
+
+# what each method's requests answer when they work
+EXPECTED_STATUS = {'GET': 200, 'POST': 302}
+
+# share of sessions each seeded student attended
+ATTENDANCE_RATE = 0.8
+
+
+class Dataset(object):
+    """Ids of everything seed() created, for the scenarios to request."""
+
+    def __init__(self):
+        self.teacher_id = None
+        self.course_ids = list()
+        self.student_ids = list()
+        self.unis = list()
+        self.rosters = dict()
+        self.spare_unis = list()
+
+
+def seed(courses, students, sessions, spare=100, rng=None):
+    """Create `courses` courses with `students` students and `sessions` closed sessions each.
+
+    Students come from a shared pool twice the size of a course, so most
+    take several courses. `spare` more students exist but take nothing, for
+    the bulk add scenario to enroll.
+    """
+    rng = rng or random.Random(4156)
+    data = Dataset()
+
+    teacher = teachers_model.Teacher(
+        name='Benchmark Teacher', email='teacher@example.com').get_or_create()
+    teacher.register_as_teacher()
+    data.teacher_id = teacher.get_id()
+
+    pool = students * 2
+    data.unis = ['bench{0}'.format(i) for i in range(pool + spare)]
+    keys = teacher.create_entities('user', [
+        {'name': 'Student ' + uni, 'email': uni + '@example.com', 'uni': uni}
+        for uni in data.unis
+    ])
+    users_model.save_indexes(teacher.datastore, teacher.datastore.get_multi(keys))
+    data.student_ids = [key.id for key in keys[:pool]]
+    data.spare_unis = data.unis[pool:]
+
+    start = datetime(2017, 9, 5, 10)
+    for number in range(courses):
+        course = courses_model.Course(name='Course {0}'.format(number)).get_or_create()
+        course_id = course.get_id()
+        roster = rng.sample(data.student_ids, min(students, pool))
+
+        course.create_entities('teaches', [
+            {'course_id': course_id, 'teacher_id': teacher.get_id()}])
+        course.create_entities('takes', [
+            {'course_id': course_id, 'student_id': id} for id in roster])
+        windows = course.create_entities('attendance_window', [{
+            'course_id': course_id,
+            'opened_at': start + timedelta(days=7 * i),
+            'closed_at': start + timedelta(days=7 * i, minutes=75),
+            'secret': rng.randint(1000, 9999)
+        } for i in range(sessions)])
+        for window in windows:
+            course.create_entities('attendance_record', [
+                {'course_id': course_id, 'attendance_window_id': window.id, 'user_id': id}
+                for id in roster if rng.random() < ATTENDANCE_RATE
+            ])
+
+        course.rebuild_membership_summary()
+        course.rebuild_counters()
+        data.course_ids.append(course_id)
+        data.rosters[course_id] = roster
+
+    return data
+
+
+# storage calls of every request since the scenario started
+_captured = list()
+
+
+def capture_request_stats(app):
+    @app.after_request
+    def capture(response):
+        stats = instrumentation.current()
+        if stats is not None:
+            _captured.append(stats.to_dict())
+        return response
+
+
+def signed_in(user_id):
+    test_client = imhere.app.test_client()
+    with test_client.session_transaction() as session:
+        session['user_id'] = user_id
+    return test_client
+
+
+def scenario_requests(name, data, requests, rng):
+    """The (user id, method, path, form) requests that make up a scenario."""
+    teacher = data.teacher_id
+    courses = data.course_ids
+    if name == 'home':
+        users = [teacher] + data.student_ids
+        return [(rng.choice(users), 'GET', '/', None) for _ in range(requests)]
+
+    if name == 'view_course':
+        return [(teacher, 'GET', '/courses/{0}'.format(rng.choice(courses)), None)
+                for _ in range(requests)]
+
+    if name == 'records':
+        picks = [rng.choice(courses) for _ in range(requests)]
+        return [(teacher, 'GET', '/courses/{0}/students/{1}/records'.format(
+            course, rng.choice(data.rosters[course])), None) for course in picks]
+
+    if name == 'sign_in_burst':
+        course = courses[0]
+        secret = courses_model.Course(id=course).open_session()
+        return [(student, 'POST', '/courses/{0}/sessions/current/sign-in'.format(course),
+                 {'secret': str(secret)})
+                for student in data.rosters[course][:requests]]
+
+    if name == 'bulk_roster_add':
+        batch = max(1, len(data.spare_unis) // max(1, min(requests, len(courses))))
+        return [(teacher, 'POST', '/courses/{0}/students'.format(course),
+                 {'unis': '\n'.join(rng.sample(data.spare_unis, batch))})
+                for course in courses[:requests]]
+
+    if name == 'destroy':
+        # destroys what it touches, so it runs last and at most once per course
+        return [(teacher, 'POST', '/courses/{0}/destroy'.format(course), None)
+                for course in courses[max(0, len(courses) - requests):]]
+
+    raise ValueError('Unknown scenario ' + repr(name))
+
+
+def check_response(test_client, method, path, response):
+    """Raise unless `response` is what the route answers when it works.
+
+    Pages answer 200. Forms redirect home whether or not they worked (the
+    requests have no referrer), so a POST also fails if it left an error
+    message in the session.
+    """
+    expected = EXPECTED_STATUS[method]
+    if response.status_code != expected:
+        raise RuntimeError('{0} {1} answered {2} instead of {3}'.format(
+            method, path, response.status, expected))
+    if method != 'POST':
+        return
+
+    if urlparse.urlparse(response.location).path != '/':
+        raise RuntimeError('{0} {1} redirected to {2}'.format(method, path, response.location))
+    with test_client.session_transaction() as session:
+        errors = [message['message'] for message in session.get('messages', [])
+                  if message['type'] == 'error']
+    if errors:
+        raise RuntimeError('{0} {1} failed: {2}'.format(method, path, '; '.join(errors)))
+
+
+def mean(values):
+    if not values:
+        return None
+    return round(sum(values) / float(len(values)), 2)
+
+
+def run_scenario(name, data, requests, threads, rng):
+    planned = scenario_requests(name, data, requests, rng)
+    clients = dict()
+
+    def send(request):
+        user_id, method, path, form = request
+        test_client = clients.get(user_id)
+        if test_client is None:
+            test_client = clients[user_id] = signed_in(user_id)
+        started = time.time()
+        response = test_client.open(path, method=method, data=form)
+        latency = time.time() - started
+        check_response(test_client, method, path, response)
+        return latency
+
+    del _captured[:]
+    started = time.time()
+    if threads > 1:
+        executor = ThreadPoolExecutor(max_workers=threads)
+        try:
+            latencies = list(executor.map(send, planned))
+        finally:
+            executor.shutdown()
+    else:
+        latencies = [send(request) for request in planned]
+    elapsed = time.time() - started
+    samples = list(_captured)
+
+    # figures a scenario with no requests doesn't have are None
+    calls = [sample['calls'] for sample in samples]
+    operations = OrderedDict()
+    for operation in instrumentation.OPERATIONS:
+        operations[operation] = mean([sample['counts'][operation] for sample in samples])
+
+    return OrderedDict([
+        ('requests', len(latencies)),
+        ('seconds', round(elapsed, 3)),
+        ('throughput', round(len(latencies) / elapsed, 1) if elapsed else None),
+        ('latency_ms', OrderedDict(
+            ('p{0}'.format(int(fraction * 100)),
+             round(instrumentation.percentile(latencies, fraction) * 1000, 2)
+             if latencies else None)
+            for fraction in (0.5, 0.9, 0.99))),
+        ('calls', OrderedDict([
+            ('mean', mean(calls)),
+            ('p50', instrumentation.percentile(calls, 0.5)),
+            ('max', max(calls) if calls else None)
+        ])),
+        ('per_request', operations)
+    ])
+
+
+def print_results(results):
+    print '{0:<16} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>10} {7:>9}'.format(
+        'scenario', 'requests', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'calls avg', 'calls max')
+    for name, result in results['scenarios'].items():
+        print '{0:<16} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>10} {7:>9}'.format(
+            name, result['requests'], result['throughput'], result['latency_ms']['p50'],
+            result['latency_ms']['p90'], result['latency_ms']['p99'], result['calls']['mean'],
+            result['calls']['max'])
+
+
+def compare(before_path, after_path):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before = json.load(before_file)['scenarios']
+        after = json.load(after_file)['scenarios']
+
+    print '{0:<16} {1:>20} {2:>20} {3:>20}'.format(
+        'scenario', 'req/s', 'p50 ms', 'calls avg')
+    for name in after:
+        if name not in before:
+            continue
+        old, new = before[name], after[name]
+        print '{0:<16} {1:>20} {2:>20} {3:>20}'.format(
+            name,
+            '{0} -> {1}'.format(old['throughput'], new['throughput']),
+            '{0} -> {1}'.format(old['latency_ms']['p50'], new['latency_ms']['p50']),
+            '{0} -> {1}'.format(old['calls']['mean'], new['calls']['mean']))
+
+
+def save(results, label):
+    if not os.path.isdir(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+    name = '{0}{1}.json'.format(
+        datetime.now().strftime('%Y%m%d-%H%M%S'), '-' + label if label else '')
+    path = os.path.join(RESULTS_DIR, name)
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    return path
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Load test the routes offline.')
+    parser.add_argument('--courses', type=int, default=20)
+    parser.add_argument('--students', type=int, default=200, help='students per course')
+    parser.add_argument('--sessions', type=int, default=20, help='sessions per course')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='run only these scenarios (repeatable)')
+    parser.add_argument('--label', default='', help='appended to the results file name')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two saved runs instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    # run background jobs inline so their work is part of the request being timed
+    imhere.job_runner = jobs.JobRunner(jobs.LocalQueue())
+    capture_request_stats(imhere.app)
+    memory_backend.reset()
+
+    started = time.time()
+    data = seed(args.courses, args.students, args.sessions)
+    print 'seeded {0} courses x {1} students x {2} sessions in {3:.1f}s'.format(
+        args.courses, args.students, args.sessions, time.time() - started)
+
+    rng = random.Random(156)
+    results = OrderedDict([
+        ('parameters', OrderedDict([
+            ('backend', os.environ['DATA_BACKEND']),
+            ('courses', args.courses),
+            ('students', args.students),
+            ('sessions', args.sessions),
+            ('requests', args.requests),
+            ('threads', args.threads)
+        ])),
+        ('scenarios', OrderedDict())
+    ])
+    for name in [name for name in SCENARIOS if not args.scenario or name in args.scenario]:
+        results['scenarios'][name] = run_scenario(name, data, args.requests, args.threads, rng)
+
+    print_results(results)
+    print 'saved to ' + save(results, args.label)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
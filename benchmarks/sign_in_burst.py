@@ -0,0 +1,68 @@
+"""Sustained sign-ins per second during the start-of-lecture burst.
+
+Seeds a course with a class of students, opens an attendance window and has
+every student sign in at once from a pool of threads, like a lecture hall
+full of phones. Reports throughput and latency percentiles.
+
+Run from the repository root against the Datastore emulator:
+
+    export DATASTORE_EMULATOR_HOST=localhost:8081
+    python -m benchmarks.sign_in_burst [students] [threads]
+"""
+
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from models import courses_model, students_model, users_model
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def seed(size):
+    course = courses_model.Course(name='Sign-in burst').get_or_create()
+    unis = ['burst{0}'.format(i) for i in range(size)]
+    keys = course.create_entities('user', [
+        {'name': 'Student ' + uni, 'email': uni + '@example.com', 'uni': uni} for uni in unis
+    ])
+    users = course.datastore.get_multi(keys)
+    users_model.save_indexes(course.datastore, users)
+    course.add_students_by_uni(unis)
+    students = [students_model.Student.from_entity(entity) for entity in users]
+    return course, students
+
+
+def main(argv):
+    size = int(argv[0]) if len(argv) > 0 else 300
+    threads = int(argv[1]) if len(argv) > 1 else 32
+
+    course, students = seed(size)
+    try:
+        secret = course.open_session()
+
+        def sign_in(student):
+            started = time.time()
+            assert course.sign_student_in(student, secret), 'Sign in rejected'
+            return time.time() - started
+
+        started = time.time()
+        executor = ThreadPoolExecutor(max_workers=threads)
+        latencies = list(executor.map(sign_in, students))
+        elapsed = time.time() - started
+        executor.shutdown()
+
+        print '{0} sign-ins on {1} threads in {2:.2f}s: {3:.1f}/s'.format(
+            size, threads, elapsed, size / elapsed)
+        print 'latency ms: p50 {0:.1f}  p95 {1:.1f}  p99 {2:.1f}  max {3:.1f}'.format(
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000, max(latencies) * 1000)
+    finally:
+        course.destroy()
+        course.datastore.delete_multi([student.get_key() for student in students])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -28,8 +28,99 @@ SECRET_KEY = 'secret'
 # configure the respective settings for the one you choose below.
 # You do not have to configure the other data backends. If unsure, choose
 # 'datastore' as it does not require any additional configuration.
-DATA_BACKEND = 'datastore'
+# 'memory' keeps everything in the process and needs no project at all; use it
+# to run the tests and benchmarks offline, e.g. `DATA_BACKEND=memory pytest`.
+DATA_BACKEND = os.environ.get('DATA_BACKEND', 'datastore')
+
+# The 'cloudsql' backend keeps its tables in this SQLite database file.
+SQL_DATABASE = os.environ.get('SQL_DATABASE', 'imhere.sqlite3')
 
 # Google Cloud Project ID. This can be found on the 'Overview' page at
 # https://console.developers.google.com
 PROJECT_ID = 'coms4156-168718'
+
+# Datastore clients are expensive to build (auth plus channel setup) and safe
+# to share between threads, so the models draw them from a process-wide pool
+# of this size instead of building one per model instance.
+DATASTORE_CLIENT_POOL_SIZE = 4
+
+# Datastore queries are eventually consistent, so after a write the models
+# wait until it is visible. 'none' never waits, 'lookup' confirms with a
+# strongly consistent key lookup, and 'backoff' polls the affected query with
+# exponential backoff. Waiting gives up after the deadline (in seconds).
+WRITE_CONFIRMATION_STRATEGY = 'backoff'
+WRITE_CONFIRMATION_DEADLINE = 10.0
+
+# Long operations (bulk roster imports, course deletion) run as background
+# jobs. 'threads' runs them on a pool of JOB_WORKERS in-process threads;
+# 'local' runs them inline, which is handy for tests.
+JOB_QUEUE_BACKEND = 'threads'
+JOB_WORKERS = 4
+
+# Deleting a course deletes its attendance and membership entities in
+# batches; this many batches are deleted in parallel.
+CASCADE_DELETE_WORKERS = 4
+
+# Pages that need several independent reads (a course's roster, open window
+# and counts, or each of a user's roles on the home page) make them at the
+# same time on a shared pool of this many threads. 1 makes them in turn.
+FANOUT_WORKERS = 8
+
+# Each course's open attendance window (or lack of one) is cached for this
+# many seconds. Opening and closing a window update the cache immediately;
+# the TTL bounds how stale other instances' copies can get.
+OPEN_SESSION_CACHE_TTL = 5
+OPEN_SESSION_CACHE_SIZE = 10000
+
+# Sign-ins check membership against a cached copy of the course roster,
+# kept for this many seconds; anyone not in it is double-checked with a query.
+ROSTER_CACHE_TTL = 60
+ROSTER_CACHE_SIZE = 1000
+
+# Users are found by UNI or email through index entities keyed by the value,
+# and the ids they point to are cached for this many seconds. A cached id
+# that no longer matches is looked up again.
+USER_INDEX_CACHE_TTL = 300
+USER_INDEX_CACHE_SIZE = 10000
+
+# Users saved before the UNI and email indexes existed have no index
+# entities, so a value the index doesn't know is also looked for with a
+# query, and a user found that way is indexed then. Turn it off once
+# `python -m models.migrations user-indexes` has indexed them all.
+LEGACY_USERS = True
+
+# Join entities (takes, tas, teaches, attendance records) are stored under
+# keys made from the ids they join. Ones saved before that have allocated ids
+# that key lookups can't see, so while this is on a lookup that misses falls
+# back to the old query. Turn it off once `python -m models.migrations
+# join-keys` has moved them all.
+LEGACY_JOINS = True
+
+# Every course keeps a denormalized summary of its teacher, TA and student
+# ids, updated transactionally with each membership change. When enabled,
+# membership checks and rosters are answered from that one entity instead
+# of join table queries. After running with this off, rebuild summaries with
+# `python -m models.migrations membership-summaries` before turning it on.
+MEMBERSHIP_SUMMARY = True
+
+# Attendance totals are kept in counters updated on every write. A course's
+# total is split over this many shards so a class signing in at once doesn't
+# queue up on a single entity.
+ATTENDANCE_COUNTER_SHARDS = 20
+
+# Every request's storage calls are counted and timed. They are reported in
+# an X-Storage-Calls header in debug mode, a JSON log line per request and
+# rolling percentiles over the last STATS_WINDOW requests of each endpoint at
+# /_stats, which only teachers can see. A request that makes more calls than
+# its budget fails, which catches N+1 regressions in tests. RPC_BUDGET
+# applies to every endpoint without an entry in RPC_BUDGETS, e.g.
+# {'view_course': 20}; None means no budget.
+RPC_BUDGET = None
+RPC_BUDGETS = {}
+STATS_WINDOW = 1000
+
+# The signed in user's profile and roles are kept in the signed session and
+# read again after PRINCIPAL_TTL seconds, instead of on every request. Roles
+# the app changes itself (registering) are refreshed right away; changes made
+# from another session show up within this many seconds.
+PRINCIPAL_TTL = 300
@@ -0,0 +1,64 @@
+"""Serializes streams of rows, e.g. Course.iter_attendance, for download.
+
+Both formats are generators of byte strings, so a Flask response can send
+each chunk as soon as it's ready without holding the whole export.
+"""
+
+import csv
+import io
+import itertools
+import json
+
+
+# rows are buffered into chunks of this many before they're sent
+CHUNK_ROWS = 500
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson'
+}
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _chunks(lines):
+    chunk = list()
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= CHUNK_ROWS:
+            yield ''.join(chunk)
+            chunk = list()
+    if chunk:
+        yield ''.join(chunk)
+
+
+def to_csv(rows, fields):
+    """A header line of `fields`, then one line per row."""
+    def lines():
+        buffer = io.BytesIO()
+        writer = csv.writer(buffer)
+        for values in itertools.chain(
+                [fields], ([_text(row.get(field)) for field in fields] for row in rows)):
+            writer.writerow(values)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    return _chunks(lines())
+
+
+def to_jsonl(rows):
+    """One JSON object per line per row, with times in ISO 8601."""
+    def default(value):
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        raise TypeError(repr(value) + ' is not JSON serializable')
+
+    return _chunks(json.dumps(row, default=default) + '\n' for row in rows)
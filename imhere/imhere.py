@@ -2,16 +2,24 @@
 
 import os
 import httplib2
+import json
 
 import sys
+import time
 import traceback
 import oauth2client
 import apiclient
 import flask
+import config
+import exports
+import jobs
+import principal
+import view_models
 
 from uuid import uuid4
 from flask import Flask, render_template, request, abort, url_for
 from models import users_model, teachers_model, students_model, courses_model, tas_model
+from models import client_pool, instrumentation
 from functools import wraps
 
 
@@ -19,6 +27,20 @@ tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 app = Flask(__name__, template_folder=tmpl_dir)
 app.secret_key = str(uuid4())
 
+job_runner = jobs.JobRunner(jobs.make_queue(config.JOB_QUEUE_BACKEND, config.JOB_WORKERS))
+
+endpoint_stats = instrumentation.EndpointStats(config.STATS_WINDOW)
+
+# bulk roster jobs report progress after every chunk of this many UNIs
+BULK_ADD_CHUNK_SIZE = 100
+
+# members per page of the roster API, unless the request asks for fewer
+ROSTER_PAGE_SIZE = 100
+
+# columns of the attendance CSV export, in order
+EXPORT_FIELDS = ['uni', 'name', 'email', 'role', 'session_id', 'opened_at', 'closed_at',
+                 'attended']
+
 
 def merge_dicts(*dicts):
     result = {}
@@ -100,27 +122,58 @@ def common_view_variables():
     )
 
 
+# registered before convert_params so the lookups it makes are counted too
+@app.url_value_preprocessor
+def start_instrumentation(endpoint, values):
+    instrumentation.start(budget=config.RPC_BUDGETS.get(endpoint, config.RPC_BUDGET))
+
+
+@app.after_request
+def report_instrumentation(response):
+    stats = instrumentation.current()
+    if stats is None:
+        return response
+
+    latency = time.time() - stats.started
+    endpoint_stats.add(request.endpoint, latency, stats)
+    instrumentation.log_request(
+        request.endpoint, request.method, response.status_code, latency, stats)
+    if app.debug:
+        response.headers['X-Storage-Calls'] = stats.summary()
+    return response
+
+
 @app.url_value_preprocessor
 def convert_params(endpoint, values):
     if not values:
         return
     if 'course_id' in values:
-        course = courses_model.Course(id=values['course_id'])
-        if not course.fetched:
-            raise ValueError('Course does not exist')
-        values['course'] = course
+        values['course'] = courses_model.Course(id=values['course_id'])
 
     if 'student_id' in values:
-        student = students_model.Student(id=values['student_id'])
-        if not student.fetched:
-            raise ValueError('Student does not exist')
-        values['student'] = student
+        values['student'] = students_model.Student(id=values['student_id'])
 
     if 'ta_id' in values:
-        ta = tas_model.TA(id=values['ta_id'])
-        if not ta.fetched:
-            raise ValueError('TA does not exist')
-        values['ta'] = ta
+        values['ta'] = tas_model.TA(id=values['ta_id'])
+
+    # the models load lazily, so checking the first fetches them all at once
+    for name, description in (('course', 'Course'), ('student', 'Student'), ('ta', 'TA')):
+        if name in values and not values[name].fetched:
+            raise ValueError(description + ' does not exist')
+
+
+# pay for client auth/channel setup once, before the first request that needs
+# a client, instead of on import (which would need credentials just to load
+# the app) or spread over the first few requests. On App Engine the first
+# request is the warmup request, before the instance takes traffic.
+@app.before_first_request
+def warm_up_clients():
+    client_pool.warm_up()
+
+
+@app.route('/_ah/warmup')
+def warmup():
+    return ''
 
 
 # make sure user is authenticated w/ live session on every request
@@ -131,27 +184,21 @@ def manage_session():
     if request.path == '/oauth/callback':
         return
 
-    request.user_models = {}
-    user_id = flask.session.get('user_id', None)
-    if user_id is not None:
-        user = users_model.User(id=user_id)
-        request.user_models['user'] = user
-        if user.is_teacher():
-            request.user_models['teacher'] = teachers_model.Teacher(id=user_id)
-        if user.is_student():
-            request.user_models['student'] = students_model.Student(id=user_id)
-            request.user_models['ta'] = request.user_models['student'].as_TA()
+    # roles come from the session; the models are only read if a route uses them
+    request.user_models = principal.user_models(principal.load(flask.session))
 
 
 @app.before_request
 def manage_messages():
-    request.messages = flask.session.get('messages', list())
+    flask.session.setdefault('messages', list())
+    report_finished_bulk_adds()
+    request.messages = flask.session['messages']
     flask.session['messages'] = list()
 
 
 @app.errorhandler(Exception)
 def handle_app_error(e):
-    if request.method == 'GET':
+    if request.method == 'GET' or isinstance(e, instrumentation.RpcBudgetExceeded):
         traceback.print_exc(file=sys.stdout)
         raise e
 
@@ -172,7 +219,10 @@ def handle_internal_server_error(e):
 @app.route('/', methods=['GET'])
 @templated('home.html')
 def home():
-    return common_view_variables()
+    variables = common_view_variables()
+    if 'user' in request.user_models:
+        variables['home'] = view_models.build_home(request.user_models)
+    return variables
 
 
 @app.route('/login', methods=['POST'])
@@ -200,7 +250,7 @@ def close_session(course, **kwargs):
 @app.route('/courses/<int:course_id>/sessions/current/sign-in', methods=['POST'])
 def sign_in(course, **kwargs):
     signer = request.user_models.get('student', None) or request.user_models.get('ta', None)
-    if not course.has_student(signer) and not course.has_TA(signer):
+    if signer is None:
         raise ValueError('User must be in course to sign in')
 
     secret = request.form.get('secret', None)
@@ -213,27 +263,104 @@ def sign_in(course, **kwargs):
     return flask.redirect(request.referrer or url_for('home'))
 
 
+def clean_unis(unis):
+    return [uni.strip('\r') for uni in unis if uni.strip('\r')]
+
+
+def report_bulk_add(report, role):
+    """Turn a per-UNI report from Course.add_*_by_uni into session messages."""
+    added = [uni for uni in report if report[uni] == courses_model.ADDED]
+    enrolled = [uni for uni in report if report[uni] == courses_model.ALREADY_ENROLLED]
+    unknown = sorted(uni for uni in report if report[uni] == courses_model.UNKNOWN)
+
+    for uni in unknown:
+        flask.session['messages'].append({
+            'type': 'warning',
+            'message': 'No ' + role + ' with UNI ' + uni + ' exists'
+        })
+    flask.session['messages'].append({
+        'type': 'info',
+        'message': 'Added {0} {1}s; {2} already in course, {3} unknown'.format(
+            len(added), role, len(enrolled), len(unknown))
+    })
+
+
+def job_response(job, description):
+    """Answer a request that started `job`: JSON for API clients, else a redirect."""
+    if request.accept_mimetypes.best == 'application/json':
+        return flask.jsonify(job.to_dict()), 202
+
+    if job.status == jobs.FAILED:
+        raise ValueError(job.error)
+    if job.status != jobs.DONE:
+        flask.session['messages'].append({
+            'type': 'info',
+            'message': description + ' in the background (job ' + job.id + ')'
+        })
+    return flask.redirect(request.referrer or url_for('home'))
+
+
+def enqueue_bulk_add(unis, add, role):
+    unis = clean_unis(unis)
+
+    def work(job):
+        for start in range(0, len(unis), BULK_ADD_CHUNK_SIZE):
+            chunk = unis[start:start + BULK_ADD_CHUNK_SIZE]
+            job.advance(add(chunk), count=len(chunk))
+
+    # an import of one chunk is quick enough to wait for and report right away
+    job = job_runner.enqueue(
+        'add ' + role + 's', work, owner_id=flask.session.get('user_id'), total=len(unis),
+        inline=len(unis) <= BULK_ADD_CHUNK_SIZE)
+    if job.status == jobs.DONE:
+        report_bulk_add(job.results, role)
+    else:
+        # reported on the first page the user loads after it finishes
+        flask.session['bulk_adds'] = flask.session.get('bulk_adds', list()) + [
+            {'job_id': job.id, 'role': role}]
+    return job
+
+
+def report_finished_bulk_adds():
+    """Turn the reports of this session's finished background imports into messages."""
+    running = list()
+    for bulk_add in flask.session.get('bulk_adds', list()):
+        job = job_runner.get(bulk_add['job_id'])
+        if job is None:
+            continue
+        if job.status == jobs.DONE:
+            report_bulk_add(job.results, bulk_add['role'])
+        elif job.status == jobs.FAILED:
+            flask.session['messages'].append({
+                'type': 'error',
+                'message': 'Adding ' + bulk_add['role'] + 's failed: ' + job.error
+            })
+        else:
+            running.append(bulk_add)
+
+    if 'bulk_adds' in flask.session:
+        flask.session['bulk_adds'] = running
+
+
 def bulk_add_student_to_course(unis, course):
     """Add unis to course. Unis should already be split into a list.
 
-    Will gracefully issue warning on invalid unis and continue processing rest.
+    Runs as a job, in the background unless it's a single chunk. Will
+    gracefully issue warning on invalid unis and continue processing rest.
 
     Args:
         unis (list of strings): List of unis of students to add.
         course (Course): Course to add students to.
+
+    Returns:
+        Job: The job adding the students.
     """
-    for uni in unis:
-        uni = uni.strip('\r')
-        if not uni:
-            continue
-        student = students_model.Student(uni=uni)
-        if not student.fetched:
-            flask.session['messages'].append({
-                'type': 'warning',
-                'message': 'No student with UNI ' + uni + ' exists'
-            })
-        else:
-            course.add_student(student)
+    return enqueue_bulk_add(unis, course.add_students_by_uni, 'student')
+
+
+def bulk_add_ta_to_course(unis, course):
+    """Add unis to course as TAs, like bulk_add_student_to_course."""
+    return enqueue_bulk_add(unis, course.add_TAs_by_uni, 'TA')
 
 
 @app.route('/courses/<int:course_id>/students', methods=['POST'])
@@ -241,7 +368,8 @@ def bulk_add_student_to_course(unis, course):
 def add_student_to_course(course, **kwargs):
     if 'unis' in request.form and request.form['unis'] != '':
         unis = request.form['unis'].split('\n')
-        bulk_add_student_to_course(unis, course)
+        job = bulk_add_student_to_course(unis, course)
+        return job_response(job, 'Adding students')
     elif 'uni' not in request.form or not request.form['uni']:
         raise ValueError('Must include UNI')
     else:
@@ -267,18 +395,8 @@ def remove_student_from_course(course, student, **kwargs):
 def add_ta_to_course(course, **kwargs):
     if 'unis' in request.form and request.form['unis'] != '':
         unis = request.form['unis'].split('\n')
-        for uni in unis:
-            uni = uni.strip('\r')
-            if not uni:
-                continue
-            ta = tas_model.TA(uni=uni)
-            if not ta.fetched:
-                flask.session['messages'].append({
-                    'type': 'warning',
-                    'message': 'No TA with UNI ' + uni + ' exists'
-                })
-            else:
-                course.add_TA(ta)
+        job = bulk_add_ta_to_course(unis, course)
+        return job_response(job, 'Adding TAs')
     elif 'uni' not in request.form or not request.form['uni']:
         raise ValueError('Must include UNI')
     else:
@@ -311,8 +429,31 @@ def create_course():
 @app.route('/courses/<int:course_id>/destroy', methods=['POST'])
 @must_be_teacher
 def destroy_course(course, **kwargs):
-    course.destroy()
-    return flask.redirect(request.referrer or url_for('home'))
+    # a failed destroy's job reports its checkpoint; posting it back resumes from there
+    checkpoint = request.form.get('checkpoint')
+    if checkpoint:
+        index, cursor = json.loads(checkpoint)
+        checkpoint = (index, cursor)
+
+    def progress(job, count, checkpoint):
+        job.advance({'checkpoint': list(checkpoint)}, count=count)
+
+    job = job_runner.enqueue(
+        'destroy course',
+        lambda job: course.destroy(
+            checkpoint=checkpoint or None,
+            on_progress=lambda count, checkpoint: progress(job, count, checkpoint)),
+        owner_id=flask.session.get('user_id'))
+    return job_response(job, 'Deleting ' + course.get('name'))
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@must_be_signed_in
+def job_status(job_id):
+    job = job_runner.get(job_id)
+    if job is None or job.owner_id != request.user_models['user'].get_id():
+        abort(404)
+    return flask.jsonify(job.to_dict())
 
 
 @app.route('/courses/<int:course_id>/tas/<int:ta_id>/records')
@@ -362,12 +503,69 @@ def modify_ta_attendance_record(ta, course, session_id, **kwargs):
     return flask.redirect(request.referrer or url_for('home'))
 
 
+@app.route('/courses/<int:course_id>/<any(students, tas):role>.json', methods=['GET'])
+@must_be_teacher_or_ta
+def roster_page(course, role, **kwargs):
+    """A page of the course's students or TAs, and the cursor of the next page (or null)."""
+    limit = min(request.args.get('limit', ROSTER_PAGE_SIZE, type=int), ROSTER_PAGE_SIZE)
+    if limit < 1:
+        abort(400)
+    get_page = course.get_students_page if role == 'students' else course.get_TAs_page
+    members, cursor = get_page(limit, request.args.get('cursor') or None)
+    return flask.jsonify({
+        'members': [{
+            'id': member.get_id(),
+            'name': member.get('name'),
+            'email': member.get('email'),
+            'uni': member.get('uni')
+        } for member in members],
+        'cursor': cursor
+    })
+
+
+@app.route('/courses/<int:course_id>/attendance', methods=['GET'])
+@must_be_teacher
+@templated('view_attendance.html')
+def view_attendance(course, **kwargs):
+    return merge_dicts(
+        common_view_variables(),
+        {
+            'course': course,
+            'matrix': course.get_attendance_matrix()
+        }
+    )
+
+
+@app.route('/courses/<int:course_id>/attendance.<any(csv, jsonl):format>', methods=['GET'])
+@must_be_teacher
+def export_attendance(course, format, **kwargs):
+    """Stream every member's attendance in every session, starting right away."""
+    rows = course.iter_attendance()
+    if format == 'csv':
+        body = exports.to_csv(rows, EXPORT_FIELDS)
+    else:
+        body = exports.to_jsonl(rows)
+
+    filename = 'attendance-{0}.{1}'.format(course.get_id(), format)
+    return flask.Response(
+        flask.stream_with_context(body),
+        mimetype=exports.FORMATS[format],
+        headers={'Content-Disposition': 'attachment; filename=' + filename})
+
+
+@app.route('/_stats', methods=['GET'])
+@must_be_teacher
+def stats():
+    return flask.jsonify(endpoint_stats.summary())
+
+
 @app.route('/courses/<int:course_id>', methods=['GET'])
 @must_be_teacher_or_ta
 @templated('view_course.html')
 def view_course(course, **kwargs):
     variables = common_view_variables()
     variables['course'] = course
+    variables['page'] = view_models.build_course(course)
     return variables
 
 
@@ -377,11 +575,12 @@ def register():
     register_as = request.form['register_as']
     user = request.user_models['user']
     if register_as == 'teacher':
-        teachers_model.Teacher(id=user.get_id()).register_as_teacher()
+        user = teachers_model.Teacher(id=user.get_id()).register_as_teacher()
     elif register_as == 'student':
         uni = request.form['uni']
-        students_model.Student(id=user.get_id()).register_as_student(uni=uni)
+        user = students_model.Student(id=user.get_id()).register_as_student(uni=uni)
 
+    principal.remember(flask.session, user)
     return flask.redirect(url_for('home'))
 
 
@@ -407,7 +606,7 @@ def oauth2callback():
         user = userinfo_client.userinfo().v2().me().get().execute()
 
         flask.session['google_user'] = user
-        flask.session['user_id'] = users_model.User(**user).get_or_create().get_id()
+        principal.remember(flask.session, users_model.User(**user).get_or_create())
 
         return flask.redirect(url_for('home'))
 
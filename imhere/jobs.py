@@ -0,0 +1,116 @@
+import sys
+import threading
+import traceback
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job(object):
+    """A unit of background work and its progress, as reported by the status endpoint."""
+
+    def __init__(self, name, owner_id=None, total=None):
+        self.id = uuid4().hex
+        self.name = name
+        self.owner_id = owner_id
+        self.status = PENDING
+        self.total = total
+        self.done = 0
+        self.results = dict()
+        self.error = None
+        self._lock = threading.Lock()
+
+    def advance(self, results=None, count=1):
+        """Record that `count` more items finished, with optional per-item results."""
+        with self._lock:
+            self.done += count
+            if results:
+                self.results.update(results)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'name': self.name,
+                'status': self.status,
+                'total': self.total,
+                'done': self.done,
+                'results': dict(self.results),
+                'error': self.error
+            }
+
+
+def _run(job, work):
+    job.status = RUNNING
+    try:
+        work(job)
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        job.error = str(e)
+        job.status = FAILED
+    else:
+        job.status = DONE
+
+
+class LocalQueue(object):
+    """Runs each job inline as soon as it is submitted. Meant for tests."""
+
+    def submit(self, job, work):
+        _run(job, work)
+
+
+class ThreadPoolQueue(object):
+    """Runs jobs on a bounded pool of in-process worker threads."""
+
+    def __init__(self, workers):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, job, work):
+        self._executor.submit(_run, job, work)
+
+
+class JobRunner(object):
+    """Hands work to a queue backend and keeps the most recent jobs for status lookups."""
+
+    def __init__(self, queue, history=1000):
+        self.queue = queue
+        self.history = history
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def enqueue(self, name, work, owner_id=None, total=None, inline=False):
+        """Start `work(job)` in the background and return its Job right away.
+
+        With `inline`, the work runs before this returns instead, for jobs
+        small enough that the request can wait for them.
+        """
+        job = Job(name, owner_id=owner_id, total=total)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+
+        if inline:
+            _run(job, work)
+        else:
+            self.queue.submit(job, work)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+
+def make_queue(backend, workers):
+    if backend == 'local':
+        return LocalQueue()
+    if backend == 'threads':
+        return ThreadPoolQueue(workers)
+    raise ValueError('Unknown job queue backend ' + repr(backend))
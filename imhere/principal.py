@@ -0,0 +1,68 @@
+"""Who is signed in, kept in the signed session instead of looked up every request.
+
+The session holds the user's id, basic profile fields and role flags, stamped
+with when they were read. manage_session trusts them for PRINCIPAL_TTL
+seconds and then reads the user again; `remember` refreshes them right away
+when the app itself changes the user's roles. The role models the routes use
+load lazily, so the user is only fetched, once for all of them, when a route
+touches one.
+"""
+
+import time
+
+import config
+from models import users_model, teachers_model, students_model
+
+
+# what is kept about the user, besides the id
+PROFILE_FIELDS = ('name', 'email', 'uni', 'teacher')
+
+
+def remember(session, user, clock=time.time):
+    """Store `user`'s id, profile and roles in the session."""
+    principal = dict((field, user.get(field)) for field in PROFILE_FIELDS)
+    principal['id'] = user.get_id()
+    principal['read_at'] = clock()
+    session['user_id'] = principal['id']
+    session['principal'] = principal
+    return principal
+
+
+def load(session, clock=time.time):
+    """The signed in user's principal, read again when missing or older than PRINCIPAL_TTL.
+
+    Returns None, and signs the session out, if the user no longer exists.
+    """
+    user_id = session.get('user_id', None)
+    if user_id is None:
+        return None
+
+    principal = session.get('principal', None)
+    if (principal is not None and principal.get('id') == user_id and
+            clock() - principal['read_at'] < config.PRINCIPAL_TTL):
+        return principal
+
+    user = users_model.User(id=user_id)
+    if not user.fetched:
+        session.pop('user_id', None)
+        session.pop('principal', None)
+        return None
+    return remember(session, user, clock)
+
+
+def user_models(principal):
+    """The models a route may use for the signed in user, none of them fetched yet.
+
+    The keys present are the user's roles, as manage_session always set them.
+    """
+    if principal is None:
+        return {}
+
+    user_id = principal['id']
+    models = {'user': users_model.User(id=user_id)}
+    if principal.get('teacher'):
+        models['teacher'] = teachers_model.Teacher(id=user_id)
+    if principal.get('uni') is not None:
+        models['student'] = students_model.Student(id=user_id)
+        models['ta'] = models['student'].as_TA()
+    return models
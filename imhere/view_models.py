@@ -0,0 +1,98 @@
+from models import courses_model, fanout
+from models.model import legacy_join, load_entities, load_models
+
+
+def _course_row(course, session, signed_in):
+    return {
+        'id': course.get_id(),
+        'name': course.get('name'),
+        'open': session is not None,
+        'secret': session['secret'] if session is not None else None,
+        'signed_in': signed_in
+    }
+
+
+def build_home(user_models):
+    """Everything the home page shows about the signed in user's courses, as plain dicts.
+
+    Costs one query per role for the course ids, made at the same time, one
+    lookup for the courses, a query per course whose open window isn't
+    cached, made at the same time, and one lookup for the user's records in
+    them. While LEGACY_JOINS is on, each open course without a record under
+    its join key also gets a query for a legacy one.
+    'taught', 'taed' and 'taken' are lists of course rows, or None when the
+    user doesn't have that role.
+    """
+    teacher = user_models.get('teacher')
+    ta = user_models.get('ta')
+    student = user_models.get('student')
+    # one lookup for all the roles before the queries below need them
+    load_models([model for model in (teacher, ta, student) if model is not None])
+
+    queries = [
+        ('taught', teacher.get_course_ids if teacher is not None else None),
+        ('taed', ta.get_taed_course_ids if ta is not None else None),
+        ('taken', student.get_course_ids if student is not None else None)
+    ]
+    results = fanout.gather(*[query for _, query in queries if query is not None])
+    ids = dict((role, results.pop(0) if query is not None else None)
+               for role, query in queries)
+    course_ids = set()
+    for role_ids in ids.values():
+        course_ids.update(role_ids or [])
+
+    courses = dict((course.get_id(), course)
+                   for course in courses_model.Course.get_multi(list(course_ids)))
+    if not courses:
+        return dict((role, [] if role_ids is not None else None)
+                    for role, role_ids in ids.items())
+
+    client = courses.values()[0].datastore
+    sessions = courses_model.get_open_sessions(client, courses.keys())
+
+    signed_in = set()
+    user = student or ta
+    if user is not None:
+        open_ids = [id for id in courses if sessions[id] is not None]
+        keys = [courses[id].attendance_record_key(sessions[id].key.id, user) for id in open_ids]
+        signed_in = set(id for id, record in zip(open_ids, load_entities(client, keys))
+                        if record is not None)
+
+        # records saved before join keys existed only turn up in a query
+        unsigned = [id for id in open_ids if id not in signed_in]
+        legacy = fanout.gather(*[
+            (lambda id=id: legacy_join(
+                client, 'attendance_record', course_id=id,
+                attendance_window_id=sessions[id].key.id, user_id=user.get_id()))
+            for id in unsigned])
+        signed_in.update(id for id, record in zip(unsigned, legacy) if record is not None)
+
+    home = dict()
+    for role, role_ids in ids.items():
+        if role_ids is None:
+            home[role] = None
+            continue
+        home[role] = [_course_row(courses[id], sessions[id], id in signed_in)
+                      for id in role_ids if id in courses]
+    return home
+
+
+def build_course(course):
+    """The course page's roster, open window and attendance counts.
+
+    The open window, the session count and the roster are read at the same
+    time, then every member's attendance count comes from one lookup.
+    'attended' maps student and TA ids to the sessions they attended.
+    """
+    def roster():
+        return course.get_students(), course.get_TAs()
+
+    session, session_count, (students, tas) = fanout.gather(
+        course.get_open_session, course.session_count, roster)
+    return {
+        'session': session,
+        'session_count': session_count,
+        'students': students,
+        'tas': tas,
+        'attended': course.attendance_counts(students + tas)
+    }
@@ -0,0 +1,85 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from models.model import MAX_MUTATION_BATCH
+
+
+class CascadeDeleter(object):
+    """Deletes every entity of `kinds` whose `field` equals `value`, a page at a time.
+
+    Keys are read with keys-only queries paged by cursor and deleted in
+    batches of at most `page_size`, so memory use doesn't grow with the
+    number of entities. With `workers` > 1 several batches are deleted in
+    parallel while the next page is read.
+
+    `checkpoint` is a (kind index, cursor) pair marking everything before it
+    as deleted. After each batch, `on_progress` is called with the number of
+    entities deleted and the new checkpoint. Passing the last checkpoint of
+    an interrupted run to a new deleter resumes where the old one stopped.
+    """
+
+    def __init__(self, client, kinds, field, value, page_size=MAX_MUTATION_BATCH, workers=1,
+                 checkpoint=None, on_progress=None):
+        self.client = client
+        self.kinds = kinds
+        self.field = field
+        self.value = value
+        self.page_size = min(page_size, MAX_MUTATION_BATCH)
+        self.workers = workers
+        self.checkpoint = checkpoint or (0, None)
+        self.on_progress = on_progress
+        self.deleted = 0
+
+    def _pages(self):
+        start, cursor = self.checkpoint
+        for index in range(start, len(self.kinds)):
+            while True:
+                query = self.client.query(kind=self.kinds[index])
+                query.add_filter(self.field, '=', self.value)
+                query.keys_only()
+                results = query.fetch(limit=self.page_size, start_cursor=cursor)
+                keys = [entity.key for entity in results]
+                if not keys:
+                    break
+
+                last_page = len(keys) < self.page_size or results.next_page_token is None
+                cursor = None if last_page else results.next_page_token
+                yield keys, (index + 1, None) if last_page else (index, cursor)
+
+                if last_page:
+                    break
+            cursor = None
+
+    def _finished(self, keys, checkpoint):
+        self.deleted += len(keys)
+        self.checkpoint = checkpoint
+        if self.on_progress is not None:
+            self.on_progress(len(keys), checkpoint)
+
+    def run(self):
+        if self.workers <= 1:
+            for keys, checkpoint in self._pages():
+                self.client.delete_multi(keys)
+                self._finished(keys, checkpoint)
+            return self.deleted
+
+        # deletes may finish out of order, but the checkpoint only moves past
+        # a page once it and every page before it are gone
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for keys, checkpoint in self._pages():
+                pending.append((executor.submit(self.client.delete_multi, keys), keys, checkpoint))
+                while len(pending) >= self.workers or (pending and pending[0][0].done()):
+                    future, done_keys, done_checkpoint = pending.popleft()
+                    future.result()
+                    self._finished(done_keys, done_checkpoint)
+
+            while pending:
+                future, done_keys, done_checkpoint = pending.popleft()
+                future.result()
+                self._finished(done_keys, done_checkpoint)
+        finally:
+            executor.shutdown(wait=True)
+
+        return self.deleted
@@ -0,0 +1,67 @@
+import itertools
+import threading
+
+import config
+from models import instrumentation, storage
+
+
+class ClientPool(object):
+    """Process-wide pool of Datastore clients shared by every model.
+
+    Building a client means authenticating and opening a channel, which is
+    far more expensive than the RPCs we make with it, so clients are created
+    once and handed out round-robin to whoever asks.
+    """
+
+    def __init__(self, project, size, backend=storage.DATASTORE):
+        if size < 1:
+            raise ValueError('Client pool must hold at least one client')
+
+        self.project = project
+        self.size = size
+        self.backend = backend
+        self._clients = list()
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def _create_client(self):
+        return instrumentation.InstrumentedClient(
+            storage.create_client(self.project, self.backend))
+
+    def get_client(self):
+        index = next(self._counter) % self.size
+        if index < len(self._clients):
+            return self._clients[index]
+
+        with self._lock:
+            while len(self._clients) <= index:
+                self._clients.append(self._create_client())
+        return self._clients[index]
+
+    def warm_up(self):
+        with self._lock:
+            while len(self._clients) < self.size:
+                self._clients.append(self._create_client())
+        return self
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ClientPool(
+                    config.PROJECT_ID, config.DATASTORE_CLIENT_POOL_SIZE, config.DATA_BACKEND)
+    return _pool
+
+
+def get_client():
+    return get_pool().get_client()
+
+
+def warm_up():
+    return get_pool().warm_up()
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import config
+from models import instrumentation
+
+
+NONE = 'none'
+LOOKUP = 'lookup'
+BACKOFF = 'backoff'
+STRATEGIES = (NONE, LOOKUP, BACKOFF)
+
+
+class WriteConfirmationTimeout(Exception):
+    pass
+
+
+class WriteConfirmer(object):
+    """Waits until a write is visible, according to a configurable strategy.
+
+    Every confirmation is given two predicates for the same write: `check`,
+    which is what callers will actually observe next (usually an eventually
+    consistent query), and `lookup`, a strongly consistent key lookup.
+
+    * ``none`` trusts the write and never polls.
+    * ``lookup`` polls `lookup`, which normally succeeds on the first try.
+    * ``backoff`` polls `check` with exponential backoff until it holds.
+
+    Polling stops at `deadline` seconds with a WriteConfirmationTimeout.
+    """
+
+    def __init__(self, strategy=BACKOFF, deadline=10.0, initial_delay=0.05, max_delay=1.0,
+                 sleep=time.sleep, clock=time.time):
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown write confirmation strategy ' + repr(strategy))
+
+        self.strategy = strategy
+        self.deadline = deadline
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self._sleep = sleep
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._stats = dict()
+
+    def confirm(self, operation, check, lookup=None):
+        if self.strategy == NONE:
+            polls = 0
+        elif self.strategy == LOOKUP:
+            polls = self._poll(operation, lookup or check)
+        else:
+            polls = self._poll(operation, check)
+
+        self._record(operation, polls)
+        return polls
+
+    def _poll(self, operation, predicate):
+        started = self._clock()
+        delay = self.initial_delay
+        polls = 0
+        while True:
+            polls += 1
+            instrumentation.record(instrumentation.POLL)
+            if predicate():
+                return polls
+
+            elapsed = self._clock() - started
+            if elapsed >= self.deadline:
+                self._record(operation, polls, timed_out=True)
+                raise WriteConfirmationTimeout(
+                    '{0} not visible after {1} polls in {2:.2f}s'.format(
+                        operation, polls, elapsed))
+
+            self._sleep(min(delay, self.deadline - elapsed))
+            delay = min(delay * 2, self.max_delay)
+
+    def _record(self, operation, polls, timed_out=False):
+        with self._lock:
+            stats = self._stats.setdefault(operation, {
+                'writes': 0,
+                'polls': 0,
+                'max_polls': 0,
+                'timeouts': 0
+            })
+            if timed_out:
+                stats['timeouts'] += 1
+                return
+            stats['writes'] += 1
+            stats['polls'] += polls
+            stats['max_polls'] = max(stats['max_polls'], polls)
+
+    def stats(self):
+        with self._lock:
+            return dict((op, dict(s)) for op, s in self._stats.items())
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = dict()
+
+
+_confirmer = WriteConfirmer(
+    strategy=config.WRITE_CONFIRMATION_STRATEGY,
+    deadline=config.WRITE_CONFIRMATION_DEADLINE
+)
+
+
+def get_confirmer():
+    return _confirmer
+
+
+def confirm(operation, check, lookup=None):
+    return _confirmer.confirm(operation, check, lookup)
@@ -0,0 +1,90 @@
+import random
+
+from google.cloud import datastore
+from models.model import get_multi, run_in_transaction
+
+
+class ShardedCounter(object):
+    """A count kept in `shards` entities, so concurrent increments rarely collide.
+
+    Each increment picks a shard at random and reading the count sums all of
+    them with one batched lookup, whatever the count is. Extra `properties`
+    are stored on every shard, e.g. a course_id so cascading deletes find
+    them.
+    """
+
+    kind = 'counter_shard'
+
+    def __init__(self, client, name, shards=1, **properties):
+        self.client = client
+        self.name = name
+        self.shards = shards
+        self.properties = properties
+
+    def _key(self, shard):
+        return self.client.key(self.kind, '{0}:{1}'.format(self.name, shard))
+
+    def keys(self):
+        return [self._key(shard) for shard in range(self.shards)]
+
+    def value(self, default=0):
+        """The count, or `default` if none of the shards has been written."""
+        shards = get_multi(self.client, self.keys())
+        if not shards:
+            return default
+        return sum(shard.get('count', 0) for shard in shards)
+
+    def reset(self, count=0):
+        """Overwrite the count, e.g. after recounting it from the source entities."""
+        self.client.delete_multi(self.keys()[1:])
+        self.client.put(self._shard(self._key(0), count))
+
+    def delete(self):
+        self.client.delete_multi(self.keys())
+
+    def _shard(self, key, count):
+        shard = datastore.Entity(key=key)
+        shard.update(self.properties)
+        shard['count'] = count
+        return shard
+
+
+def values(client, counters, default=0):
+    """The counts of all `counters`, in order, summed from one batched lookup.
+
+    Counters none of whose shards have been written count as `default`.
+    """
+    found = dict((shard.key.name, shard.get('count', 0))
+                 for shard in get_multi(client, [key for counter in counters
+                                                 for key in counter.keys()]))
+    counts = list()
+    for counter in counters:
+        shards = [found[key.name] for key in counter.keys() if key.name in found]
+        counts.append(sum(shards) if shards else default)
+    return counts
+
+
+def increment(client, changes):
+    """Add each (counter, delta) in `changes` to a random shard of its counter.
+
+    All the shards are read with a single lookup. Inside a transaction the
+    increments commit or roll back with the rest of it; otherwise they get
+    a transaction of their own.
+    """
+    changes = [(counter, delta) for counter, delta in changes if delta]
+    if not changes:
+        return
+
+    def apply():
+        keys = [counter._key(random.randrange(counter.shards)) for counter, _ in changes]
+        found = dict((shard.key.name, shard) for shard in get_multi(client, keys))
+        shards = list()
+        for key, (counter, delta) in zip(keys, changes):
+            count = found[key.name].get('count', 0) if key.name in found else 0
+            shards.append(counter._shard(key, count + delta))
+        client.put_multi(shards)
+
+    if client.current_transaction is not None:
+        apply()
+    else:
+        run_in_transaction(client, apply)
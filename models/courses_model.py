@@ -1,23 +1,107 @@
-from model import Model
+from model import Model, MAX_LOOKUP_BATCH, get_join, get_multi, iter_query, join_key, legacy_join
+from caches import LockedCache
+from cascade import CascadeDeleter
+from counters import ShardedCounter
+import counters
+import fanout
+import storage
+import cachetools
+import config
+from google.cloud import datastore
 import models
+from collections import OrderedDict
 from datetime import datetime
+from itertools import islice
+import heapq
 from random import randint
 
 
+# outcomes reported per UNI by the bulk add methods
+ADDED = 'added'
+ALREADY_ENROLLED = 'already enrolled'
+UNKNOWN = 'unknown'
+
+
+# course id -> its open attendance window, or None when it isn't taking attendance
+_open_sessions = LockedCache(cachetools.TTLCache(
+    maxsize=config.OPEN_SESSION_CACHE_SIZE,
+    ttl=config.OPEN_SESSION_CACHE_TTL
+))
+_not_cached = object()
+
+# course id -> (student ids, TA ids), so a burst of sign-ins shares one roster read
+_rosters = LockedCache(cachetools.TTLCache(
+    maxsize=config.ROSTER_CACHE_SIZE,
+    ttl=config.ROSTER_CACHE_TTL
+))
+
+
+# membership summary list property -> (join kind, member id property)
+MEMBERSHIP_LISTS = OrderedDict([
+    ('teacher_ids', ('teaches', 'teacher_id')),
+    ('ta_ids', ('tas', 'ta_id')),
+    ('student_ids', ('takes', 'student_id'))
+])
+
+
+def query_open_windows(client, course_id):
+    """All of the course's attendance windows that aren't closed, from a query."""
+    query = client.query(kind='attendance_window')
+    query.add_filter('course_id', '=', course_id)
+    query.add_filter('closed_at', '=', None)
+    return list(query.fetch())
+
+
+def query_open_session(client, course_id):
+    """The course's open attendance window, or None, from a query.
+
+    There is only ever one unless two were opened at once; then the latest
+    opened is the one that counts, wherever it's asked for.
+    """
+    windows = query_open_windows(client, course_id)
+    if not windows:
+        return None
+    return max(windows, key=lambda window: (window['opened_at'], window.key.id))
+
+
+def get_open_sessions(client, course_ids):
+    """Map each of `course_ids` to its open attendance window, or None.
+
+    Answered from the open window cache where possible. Datastore has no IN
+    filter, so the rest are a query per course, made at the same time.
+    """
+    sessions = dict()
+    missing = list()
+    for course_id in course_ids:
+        session = _open_sessions.get(course_id, _not_cached)
+        if session is _not_cached:
+            missing.append(course_id)
+        else:
+            sessions[course_id] = session
+
+    found = fanout.gather(*[
+        (lambda course_id=course_id: query_open_session(client, course_id))
+        for course_id in missing])
+    for course_id, session in zip(missing, found):
+        sessions[course_id] = session
+        _open_sessions.set(course_id, session)
+
+    return sessions
+
+
 class CourseNotTakingAttendance(Exception):
     pass
 
 
 class Course(Model):
+    kind = 'course'
+
     def __init__(self, **kwargs):
         self.datastore = self.get_client()
         self.fetched = False
         if 'id' in kwargs:
-            key = self.datastore.key('course', kwargs['id'])
-            self.model = self.datastore.get(key)
-            self.fetched = bool(self.model)
-
-        if not self.fetched:
+            self.defer_load(self.datastore.key('course', kwargs['id']), kwargs)
+        else:
             self.model = kwargs
 
     def get_or_create(self):
@@ -26,29 +110,170 @@ class Course(Model):
                 kind='course',
                 **self.model
             )
-            self.model = self.datastore.get(key)
+            self.model = self.load_entity(key)
             self.fetched = True
+            self._counted_marker().reset()
+            # a new course has no members, so there's nothing to rebuild its summary from
+            summary = self._membership_entity()
+            self.datastore.put(summary)
+            self.remember_entity(summary)
 
         return self
 
+    def _membership_key(self):
+        return self.datastore.key('course_membership', self.get_id())
+
+    def _membership_entity(self, **lists):
+        summary = datastore.Entity(
+            key=self._membership_key(), exclude_from_indexes=tuple(MEMBERSHIP_LISTS))
+        for field in MEMBERSHIP_LISTS:
+            ids = sorted(lists.get(field, []))
+            summary[field] = ids
+            summary[field.replace('_ids', '_count')] = len(ids)
+        return summary
+
+    def get_membership_summary(self):
+        """The course's teacher, TA and student ids, and how many of each, in one entity.
+
+        Every membership change keeps it current, and new courses start with
+        an empty one. Courses that predate it get theirs rebuilt from the join
+        entities on first use. That rebuild reads them with eventually
+        consistent queries, so a join written just before it, e.g. by a
+        script writing legacy joins, can be missed; rebuild the summaries
+        again with `python -m models.migrations membership-summaries` once
+        such writes are done.
+        """
+        if not self.fetched:
+            return None
+
+        key = self._membership_key()
+        summary = self.load_entity(key)
+        if summary is None:
+            rebuilt = self._membership_entity(**dict(
+                (field, self._get_member_ids(kind, member_field))
+                for field, (kind, member_field) in MEMBERSHIP_LISTS.items()))
+
+            def save():
+                existing = self.datastore.get(key)
+                if existing is not None:
+                    return existing
+                self.datastore.put(rebuilt)
+                return rebuilt
+
+            summary = self.remember_entity(self.run_in_transaction(save))
+        return summary
+
+    def _change_membership(self, field, write, add=(), remove=()):
+        """Run `write()` and apply the matching change to the summary atomically."""
+        key = self._membership_key()
+        if config.MEMBERSHIP_SUMMARY:
+            self.get_membership_summary()
+
+        def change():
+            write()
+            summary = self.datastore.get(key)
+            if summary is None:
+                return
+            ids = set(summary.get(field, []))
+            ids.update(add)
+            ids.difference_update(remove)
+            lists = dict((f, summary.get(f, [])) for f in MEMBERSHIP_LISTS)
+            lists[field] = ids
+            self.datastore.put(self._membership_entity(**lists))
+
+        self.run_in_transaction(change)
+        self.forget_entity(key)
+        _rosters.discard(self.get_id())
+
+    def rebuild_membership_summary(self):
+        """Rebuild the summary from the join entities, e.g. after writing joins directly."""
+        key = self._membership_key()
+        self.datastore.delete(key)
+        self.forget_entity(key)
+        _rosters.discard(self.get_id())
+        return self.get_membership_summary()
+
+    def _is_member(self, field, user):
+        return user.get_id() in self.get_membership_summary().get(field, [])
+
     def has_student(self, student):
         if not self.fetched or not student.fetched:
             return False
 
-        query = self.datastore.query(kind='takes')
+        if config.MEMBERSHIP_SUMMARY:
+            return self._is_member('student_ids', student)
+
+        return get_join(
+            self.datastore, 'takes', course_id=self.get_id(), student_id=student.get_id()) is not None
+
+    def get_memberships(self, users):
+        """Whether each of `users` takes and TAs the course, from one batched lookup.
+
+        Returns a dict mapping user ids to (takes course, TAs course) pairs.
+        """
+        if config.MEMBERSHIP_SUMMARY:
+            return dict((user.get_id(), (
+                self._is_member('student_ids', user),
+                self._is_member('ta_ids', user)
+            )) for user in users)
+
+        keys = list()
+        for user in users:
+            keys.append(join_key(
+                self.datastore, 'takes', course_id=self.get_id(), student_id=user.get_id()))
+            keys.append(join_key(
+                self.datastore, 'tas', course_id=self.get_id(), ta_id=user.get_id()))
+
+        found = set((entity.key.kind, entity.key.name)
+                    for entity in get_multi(self.datastore, keys))
+        memberships = dict()
+        for i, user in enumerate(users):
+            takes, tas = [(key.kind, key.name) in found for key in keys[2 * i:2 * i + 2]]
+            # joins saved before join keys existed only turn up in a query
+            if not takes:
+                takes = legacy_join(
+                    self.datastore, 'takes', course_id=self.get_id(),
+                    student_id=user.get_id()) is not None
+            if not tas:
+                tas = legacy_join(
+                    self.datastore, 'tas', course_id=self.get_id(), ta_id=user.get_id()) is not None
+            memberships[user.get_id()] = (takes, tas)
+        return memberships
+
+    def _get_members_page(self, kind, member_field, member_class, limit=None, cursor=None):
+        query = self.datastore.query(kind=kind)
         query.add_filter('course_id', '=', self.get_id())
-        query.add_filter('student_id', '=', student.get_id())
-        return len(list(query.fetch())) > 0
+        rows = query.fetch(limit=limit, start_cursor=cursor)
+        joins = list(rows)
+
+        next_cursor = None
+        if limit is not None and len(joins) == limit:
+            next_cursor = rows.next_page_token
+
+        return member_class.get_multi([join[member_field] for join in joins]), next_cursor
 
     def get_students(self):
         if not self.fetched:
             return list()
 
-        query = self.datastore.query(kind='takes')
-        query.add_filter('course_id', '=', self.get_id())
-        takes = list(query.fetch())
+        if storage.supports_joins(self.datastore):
+            return [models.students_model.Student.from_entity(self.remember_entity(user))
+                    for user in self.datastore.get_members(self.get_id(), 'takes')]
+
+        if config.MEMBERSHIP_SUMMARY:
+            return models.students_model.Student.get_multi(
+                self.get_membership_summary().get('student_ids', []))
+
+        students, _ = self._get_members_page('takes', 'student_id', models.students_model.Student)
+        return students
+
+    def get_students_page(self, limit, cursor=None):
+        """Get up to `limit` students, plus a cursor for the next page (None on the last)."""
+        if not self.fetched:
+            return list(), None
 
-        return [models.students_model.Student(id=take['student_id']) for take in takes]
+        return self._get_members_page(
+            'takes', 'student_id', models.students_model.Student, limit, cursor)
 
     def add_student(self, student):
         if not student.fetched:
@@ -60,17 +285,14 @@ class Course(Model):
         if self.has_student(student):
             return
 
-        self.create_entity(
-            kind='takes',
-            course_id=self.get_id(),
-            student_id=student.get_id()
+        self._change_membership(
+            'student_ids',
+            lambda: self.create_join(
+                'takes', course_id=self.get_id(), student_id=student.get_id()),
+            add=[student.get_id()]
         )
 
-        while not self.has_student(student):
-            pass
-
-        assert self.has_student(student), (
-            'Adding student didn\'t work. Must be something wrong with datastore.')
+        self.confirm_write('add_student', lambda: self.has_student(student))
 
     def remove_student(self, student):
         if not student.fetched:
@@ -80,47 +302,133 @@ class Course(Model):
             print 'skippideedooda'
             return
 
-        query = self.datastore.query(kind='takes')
-        query.add_filter('course_id', '=', self.get_id())
-        query.add_filter('student_id', '=', student.get_id())
-
-        keys = [take.key for take in list(query.fetch())]
+        keys = self._join_keys('takes', course_id=self.get_id(), student_id=student.get_id())
+        self._change_membership(
+            'student_ids', lambda: self.datastore.delete_multi(keys), remove=[student.get_id()])
 
         # clean up attendance records
         if not self.has_TA(student):
-            query = self.datastore.query(kind='attendance_record')
-            query.add_filter('course_id', '=', self.get_id())
-            query.add_filter('user_id', '=', student.get_id())
+            keys = keys + self._delete_attendance_records(student)
 
-            keys = keys + [take.key for take in list(query.fetch())]
+        self.confirm_write('remove_student', lambda: not self.datastore.get_multi(keys))
 
-        self.datastore.delete_multi(keys)
+    def _join_keys(self, kind, **ids):
+        # the join key, plus the allocated key of a join saved before join keys existed
+        keys = [join_key(self.datastore, kind, **ids)]
+        legacy = legacy_join(self.datastore, kind, **ids)
+        if legacy is not None:
+            keys.append(legacy.key)
+        return keys
 
-        while self.has_student(student):
-            pass
+    def _get_member_ids(self, kind, member_field):
+        query = self.datastore.query(kind=kind)
+        query.add_filter('course_id', '=', self.get_id())
+        return set(join[member_field] for join in query.fetch())
+
+    def _get_cached_roster(self):
+        roster = _rosters.get(self.get_id())
+        if roster is not None:
+            return roster
+
+        if config.MEMBERSHIP_SUMMARY:
+            summary = self.get_membership_summary()
+            roster = (
+                frozenset(summary.get('student_ids', [])),
+                frozenset(summary.get('ta_ids', []))
+            )
+        else:
+            roster = (
+                frozenset(self._get_member_ids('takes', 'student_id')),
+                frozenset(self._get_member_ids('tas', 'ta_id'))
+            )
+        _rosters.set(self.get_id(), roster)
+        return roster
 
-        assert not self.has_student(student), (
-            'Removing student didn\'t work. Must be something wrong with datastore.')
+    def _bulk_add(self, kind, member_field, unis):
+        if not self.fetched:
+            raise ValueError('Course must be saved to add members to it')
+
+        ids = models.users_model.find_ids_by_uni(self.datastore, unis)
+        joins = get_multi(self.datastore, [
+            join_key(self.datastore, kind, **{'course_id': self.get_id(), member_field: id})
+            for id in set(ids.values())
+        ])
+        existing = set(join[member_field] for join in joins)
+        if config.LEGACY_JOINS and len(existing) < len(set(ids.values())):
+            # joins saved before join keys existed only turn up in a query
+            existing.update(self._get_member_ids(kind, member_field) & set(ids.values()))
+
+        report = dict()
+        new_ids = list()
+        for uni in unis:
+            if uni in report:
+                continue
+            if uni not in ids:
+                report[uni] = UNKNOWN
+            elif ids[uni] in existing:
+                report[uni] = ALREADY_ENROLLED
+            else:
+                report[uni] = ADDED
+                new_ids.append(ids[uni])
+
+        if new_ids:
+            # too many entity groups for one transaction, so the joins are
+            # written first and the summary catches up right after
+            keys = self.create_entities(kind, [
+                {'course_id': self.get_id(), member_field: id} for id in new_ids
+            ])
+            summary_field = [f for f, (k, _) in MEMBERSHIP_LISTS.items() if k == kind][0]
+            self._change_membership(summary_field, lambda: None, add=new_ids)
+
+            self.confirm_write(
+                'bulk_add_' + kind,
+                lambda: len(get_multi(self.datastore, keys)) == len(keys)
+            )
+
+        return report
+
+    def add_students_by_uni(self, unis):
+        """Enroll the students with the given UNIs with a handful of batched RPCs.
+
+        Returns a dict mapping each UNI to ADDED, ALREADY_ENROLLED or UNKNOWN.
+        """
+        return self._bulk_add('takes', 'student_id', unis)
+
+    def add_TAs_by_uni(self, unis):
+        """Hire the TAs with the given UNIs; reports per UNI like add_students_by_uni."""
+        return self._bulk_add('tas', 'ta_id', unis)
 
     def get_TAs(self):
         if not self.fetched:
             return list()
 
-        query = self.datastore.query(kind='tas')
-        query.add_filter('course_id', '=', self.get_id())
-        tas = list(query.fetch())
+        if storage.supports_joins(self.datastore):
+            return [models.users_model.User.from_entity(self.remember_entity(user))
+                    for user in self.datastore.get_members(self.get_id(), 'tas')]
 
-        return [models.users_model.User(id=ta['ta_id']) for ta in tas]
+        if config.MEMBERSHIP_SUMMARY:
+            return models.users_model.User.get_multi(
+                self.get_membership_summary().get('ta_ids', []))
+
+        tas, _ = self._get_members_page('tas', 'ta_id', models.users_model.User)
+        return tas
+
+    def get_TAs_page(self, limit, cursor=None):
+        """Get up to `limit` TAs, plus a cursor for the next page (None on the last)."""
+        if not self.fetched:
+            return list(), None
+
+        return self._get_members_page('tas', 'ta_id', models.users_model.User, limit, cursor)
 
     def has_TA(self, ta):
         if not self.fetched or not ta.fetched:
             return False
 
-        query = self.datastore.query(kind='tas')
-        query.add_filter('course_id', '=', self.get_id())
-        query.add_filter('ta_id', '=', ta.get_id())
-        query.keys_only()
-        return len(list(query.fetch())) > 0
+        if config.MEMBERSHIP_SUMMARY:
+            return self._is_member('ta_ids', ta)
+
+        return get_join(
+            self.datastore, 'tas', course_id=self.get_id(), ta_id=ta.get_id()) is not None
 
     def add_TA(self, ta):
         if not ta.fetched:
@@ -129,16 +437,13 @@ class Course(Model):
         if self.has_TA(ta):
             return
 
-        self.create_entity(
-            kind='tas',
-            course_id=self.get_id(),
-            ta_id=ta.get_id()
+        self._change_membership(
+            'ta_ids',
+            lambda: self.create_join('tas', course_id=self.get_id(), ta_id=ta.get_id()),
+            add=[ta.get_id()]
         )
 
-        while not self.has_TA(ta):
-            pass
-
-        assert self.has_TA(ta), 'Adding TA didn\'t work. Must be something wrong with datastore'
+        self.confirm_write('add_TA', lambda: self.has_TA(ta))
 
     def remove_TA(self, ta):
         if not ta.fetched:
@@ -147,40 +452,66 @@ class Course(Model):
         if not self.has_TA(ta):
             return
 
-        query = self.datastore.query(kind='tas')
-        query.add_filter('course_id', '=', self.get_id())
-        query.add_filter('ta_id', '=', ta.get_id())
-
-        keys = [t.key for t in list(query.fetch())]
+        keys = self._join_keys('tas', course_id=self.get_id(), ta_id=ta.get_id())
+        self._change_membership(
+            'ta_ids', lambda: self.datastore.delete_multi(keys), remove=[ta.get_id()])
 
         # clean up attendance records
         if not self.has_student(ta):
-            query = self.datastore.query(kind='attendance_record')
-            query.add_filter('course_id', '=', self.get_id())
-            query.add_filter('user_id', '=', ta.get_id())
+            keys = keys + self._delete_attendance_records(ta)
 
-            keys = keys + [take.key for take in list(query.fetch())]
+        self.confirm_write('remove_TA', lambda: not self.datastore.get_multi(keys))
 
-        self.datastore.delete_multi(keys)
+    def _delete_attendance_records(self, user):
+        """Delete all of `user`'s records along with their counts; returns the keys."""
+        query = self.datastore.query(kind='attendance_record')
+        query.add_filter('course_id', '=', self.get_id())
+        query.add_filter('user_id', '=', user.get_id())
+        query.keys_only()
+        keys = [record.key for record in query.fetch()]
 
-        while self.has_TA(ta):
-            pass
+        self.datastore.delete_multi(keys)
+        counters.increment(self.datastore, [(self._attendance_counter(), -len(keys))])
+        self._attendance_counter(user).delete()
+        return keys
+
+    def _session_counter(self):
+        return ShardedCounter(
+            self.datastore, 'sessions:{0}'.format(self.get_id()), course_id=self.get_id())
+
+    def _counted_marker(self):
+        """Written once the course's counters are kept up to date; never incremented."""
+        return ShardedCounter(
+            self.datastore, 'counted:{0}'.format(self.get_id()), course_id=self.get_id())
+
+    def _attendance_counter(self, user=None):
+        """Counts the course's attendance records, or just `user`'s."""
+        if user is None:
+            return ShardedCounter(
+                self.datastore,
+                'attendance:{0}'.format(self.get_id()),
+                shards=config.ATTENDANCE_COUNTER_SHARDS,
+                course_id=self.get_id()
+            )
+        return ShardedCounter(
+            self.datastore,
+            'attendance:{0}:{1}'.format(self.get_id(), user.get_id()),
+            course_id=self.get_id()
+        )
 
-        assert not self.has_TA(ta), (
-            'Removing TA didn\'t work. Must be something wrong with datastore')
+    def _query_open_session(self):
+        return query_open_session(self.datastore, self.get_id())
 
     def get_open_session(self):
         if not self.fetched:
             return None
 
-        query = self.datastore.query(kind='attendance_window')
-        query.add_filter('course_id', '=', self.get_id())
-        query.add_filter('closed_at', '=', None)
-        sessions = list(query.fetch())
-        if len(sessions) == 0:
-            return None
+        session = _open_sessions.get(self.get_id(), _not_cached)
+        if session is _not_cached:
+            session = self._query_open_session()
+            _open_sessions.set(self.get_id(), session)
 
-        return sessions[0]
+        return session
 
     def open_session(self):
         if not self.fetched:
@@ -189,17 +520,29 @@ class Course(Model):
         session = self.get_open_session()
 
         if session is None:
-            key = self.create_entity(
-                kind='attendance_window',
+            key = self.datastore.allocate_ids(self.datastore.key('attendance_window'), 1)[0]
+            session = self.build_entity(
+                key,
                 course_id=self.get_id(),
                 opened_at=datetime.now(),
                 closed_at=None,
                 secret=randint(1000, 9999)
             )
 
-            while session is None:
-                session = self.datastore.get(key)
-                pass
+            def open_window():
+                self.datastore.put(session)
+                counters.increment(self.datastore, [(self._session_counter(), 1)])
+
+            self.run_in_transaction(open_window)
+
+            # cache the window as stored, which a strongly consistent key lookup returns
+            session = self.datastore.get(key)
+            _open_sessions.set(self.get_id(), session)
+            self.confirm_write(
+                'open_session',
+                lambda: self._query_open_session() is not None,
+                lambda: self.datastore.get(key) is not None
+            )
 
         return session['secret']
 
@@ -208,64 +551,171 @@ class Course(Model):
         if session is None:
             return
 
-        session.update({
-            'closed_at': datetime.now()
-        })
+        # every window left open, e.g. two opened at once, and the cached one,
+        # which a query may not show yet
+        windows = dict((window.key.id, window)
+                       for window in query_open_windows(self.datastore, self.get_id()))
+        windows.setdefault(session.key.id, session)
+
+        # the open window may be shared through the cache, so close copies
+        now = datetime.now()
+        closed = list()
+        for window in windows.values():
+            copy = datastore.Entity(key=window.key)
+            copy.update(window)
+            copy['closed_at'] = now
+            closed.append(copy)
+        self.datastore.put_multi(closed)
+
+        # a query may still answer with a window closed here, so the next
+        # lookup asks again instead of the cache remembering either answer
+        _open_sessions.discard(self.get_id())
+        try:
+            self.confirm_write(
+                'close_session',
+                lambda: self._query_open_session() is None,
+                lambda: all(window['closed_at'] is not None for window in
+                            get_multi(self.datastore, [copy.key for copy in closed]))
+            )
+        finally:
+            _open_sessions.discard(self.get_id())
 
-        self.datastore.put(session)
+    def session_count(self):
+        if not self.fetched:
+            return None
 
-        while self.get_open_session() is not None:
-            pass
+        return self._counts([])[0]
 
-    def session_count(self):
+    def attendance_count(self, user=None):
+        """How many sessions `user` attended, or all attendance records without one."""
         if not self.fetched:
             return None
 
+        return self._counts([self._attendance_counter(user)])[1]
+
+    def attendance_counts(self, users):
+        """Map each of `users`' ids to how many sessions they attended, in one lookup."""
+        if not self.fetched:
+            return dict()
+
+        counts = self._counts([self._attendance_counter(user) for user in users])[1:]
+        return dict((user.get_id(), count) for user, count in zip(users, counts))
+
+    def _counts(self, others):
+        """The session count followed by the counts of `others`, from one lookup.
+
+        Courses created before the counters existed have no counted marker,
+        even once sessions and sign-ins have incremented their counters, so
+        their counters are rebuilt the first time they're read.
+        """
+        tallies = [self._counted_marker(), self._session_counter()] + others
+        counts = counters.values(self.datastore, tallies, default=None)
+        if counts[0] is None:
+            self.rebuild_counters()
+            counts = counters.values(self.datastore, tallies)
+        return [count or 0 for count in counts[1:]]
+
+    def rebuild_counters(self):
+        """Recount sessions and attendance from the entities themselves."""
+        # start over, so counts of users without records don't linger
+        query = self.datastore.query(kind=ShardedCounter.kind)
+        query.add_filter('course_id', '=', self.get_id())
+        query.keys_only()
+        self.datastore.delete_multi([shard.key for shard in query.fetch()])
+
         query = self.datastore.query(kind='attendance_window')
         query.add_filter('course_id', '=', self.get_id())
         query.keys_only()
-        return len(list(query.fetch()))
+        self._session_counter().reset(len(list(query.fetch())))
+
+        query = self.datastore.query(kind='attendance_record')
+        query.add_filter('course_id', '=', self.get_id())
+        attended = dict()
+        for record in query.fetch():
+            attended[record['user_id']] = attended.get(record['user_id'], 0) + 1
+
+        self._attendance_counter().reset(sum(attended.values()))
+        users = models.users_model.User.get_multi(attended.keys())
+        for user in users:
+            self._attendance_counter(user).reset(attended[user.get_id()])
+        self._counted_marker().reset()
+
+    def get_sessions(self):
+        """All of the course's attendance windows, oldest first (see index.yaml)."""
+        query = self.datastore.query(kind='attendance_window')
+        query.add_filter('course_id', '=', self.get_id())
+        query.order = ['opened_at', 'closed_at']
+        return list(query.fetch())
+
+    def attendance_record_key(self, session_id, user):
+        """The key of `user`'s record for a session; there can only ever be one."""
+        return join_key(
+            self.datastore,
+            'attendance_record',
+            course_id=self.get_id(),
+            attendance_window_id=session_id,
+            user_id=user.get_id()
+        )
 
     def sign_student_in(self, student, secret=None):
+        """Record that `student` is here, with as few RPCs as possible.
+
+        Runs at the start of every lecture for the whole class at once, so
+        membership and the secret are checked against the cached roster and
+        open window, and the record is written with a single put under a key
+        derived from (course, window, user), which makes it idempotent.
+        """
         if not self.fetched:
             raise ValueError('Course must be saved to sign in to')
 
         if not student.fetched:
             raise ValueError('Student must be saved to sign in')
 
-        if not self.has_student(student) and not self.has_TA(student):
-            raise ValueError('Student must be in course to sign in')
+        students, tas = self._get_cached_roster()
+        is_TA = student.get_id() in tas
+        if student.get_id() not in students and not is_TA:
+            takes, is_TA = self.get_memberships([student])[student.get_id()]
+            if not takes and not is_TA:
+                raise ValueError('Student must be in course to sign in')
 
         session = self.get_open_session()
 
         if session is None:
             raise CourseNotTakingAttendance('Course\'s attendance window is not open')
 
-        if str(secret) != str(session['secret']) and not (secret is None and self.has_TA(student)):
+        if str(secret) != str(session['secret']) and not (
+                secret is None and (is_TA or self.has_TA(student))):
             return False
 
-        query = self.datastore.query(kind='attendance_record')
-        query.add_filter('attendance_window_id', '=', session.key.id)
-        query.add_filter('user_id', '=', student.get_id())
-        query.keys_only()
-        signed_in = len(list(query.fetch())) > 0
-
-        if signed_in:
+        key = self.attendance_record_key(session.key.id, student)
+        # outside the transaction, which can't run the query; new records all
+        # have the key, so the check inside it still rules out a double sign-in
+        if self._legacy_attendance_record(session.key.id, student) is not None:
             raise ValueError('Student already signed into session')
 
-        self.create_entity(
-            kind='attendance_record',
-            attendance_window_id=session.key.id,
-            user_id=student.get_id(),
-            # not strictly necessary, but good for performance in get_attendance_records
-            course_id=self.get_id()
-        )
+        def sign_in():
+            if self.datastore.get(key) is not None:
+                raise ValueError('Student already signed into session')
+
+            self.create_join(
+                'attendance_record',
+                course_id=self.get_id(),
+                attendance_window_id=session.key.id,
+                user_id=student.get_id()
+            )
+            self._count_attendance(student, 1)
 
-        while not self.currently_signed_in(student):
-            pass
+        self.run_in_transaction(sign_in)
+        self.confirm_write('sign_student_in', lambda: self.datastore.get(key))
 
         return True
 
+    def _count_attendance(self, user, delta):
+        counters.increment(self.datastore, [
+            (self._attendance_counter(), delta),
+            (self._attendance_counter(user), delta)
+        ])
+
     def currently_signed_in(self, student):
         if not student.fetched:
             raise ValueError('Unsaved user cannot be signed into a course')
@@ -278,11 +728,18 @@ class Course(Model):
         if session is None:
             return False
 
-        query = self.datastore.query(kind='attendance_record')
-        query.add_filter('user_id', '=', student.get_id())
-        query.add_filter('attendance_window_id', '=', session.key.id)
-        query.keys_only()
-        return len(list(query.fetch())) > 0
+        key = self.attendance_record_key(session.key.id, student)
+        return (self.datastore.get(key) is not None or
+                self._legacy_attendance_record(session.key.id, student) is not None)
+
+    def _legacy_attendance_record(self, session_id, user):
+        return legacy_join(
+            self.datastore,
+            'attendance_record',
+            course_id=self.get_id(),
+            attendance_window_id=session_id,
+            user_id=user.get_id()
+        )
 
     def get_attendance_records(self, student=None, ta=None):
         query = self.datastore.query(kind='attendance_record')
@@ -303,29 +760,130 @@ class Course(Model):
         if not self.has_student(student) and not self.has_TA(student):
             return []
 
-        query = self.datastore.query(kind='attendance_window')
-        query.add_filter('course_id', '=', self.get_id())
-        windows = list(query.fetch())
+        if storage.supports_joins(self.datastore):
+            return self.datastore.get_attendance_details(self.get_id(), student.get_id())
 
         query = self.datastore.query(kind='attendance_record')
         query.add_filter('user_id', '=', student.get_id())
         query.add_filter('course_id', '=', self.get_id())
-        records = list(query.fetch())
+        attended = set(record['attendance_window_id'] for record in query.fetch())
+
+        return [{
+            'opened_at': window['opened_at'],
+            'closed_at': window['closed_at'],
+            'user_id': student.get_id(),
+            'session_id': window.key.id,
+            'attended': window.key.id in attended
+        } for window in self.get_sessions()]
+
+    def get_attendance_matrix(self):
+        """Attendance of every student and TA in every session of the course.
+
+        Costs one query for the sessions, one for the records and the batched
+        roster lookups, however many members and sessions there are. Returns
+        a dict with 'sessions', ordered by opening time, and 'members', each
+        with an 'attended' list parallel to 'sessions'.
+        """
+        if not self.fetched:
+            raise ValueError('Can\'t get attendance of an unsaved course')
 
-        details = list()
-        for window in windows:
-            relevant_records = [record for record in records
-                                if record['attendance_window_id'] == window.key.id]
-            details.append({
-                'opened_at': window['opened_at'],
-                'closed_at': window['closed_at'],
-                'user_id': student.get_id(),
+        windows = self.get_sessions()
+
+        query = self.datastore.query(kind='attendance_record')
+        query.add_filter('course_id', '=', self.get_id())
+        attended = dict(((record['user_id'], record['attendance_window_id']), record)
+                        for record in query.fetch())
+
+        members = OrderedDict()
+        for role, users in [('student', self.get_students()), ('TA', self.get_TAs())]:
+            for user in users:
+                if user.get_id() in members:
+                    members[user.get_id()]['roles'].append(role)
+                    continue
+
+                row = [(user.get_id(), window.key.id) in attended for window in windows]
+                members[user.get_id()] = {
+                    'user_id': user.get_id(),
+                    'name': user.get('name'),
+                    'email': user.get('email'),
+                    'uni': user.get('uni'),
+                    'roles': [role],
+                    'attended': row,
+                    'total': sum(row)
+                }
+
+        return {
+            'sessions': [{
                 'session_id': window.key.id,
-                'attended': len(relevant_records) > 0
-            })
-        details.sort(key=lambda record: [record['opened_at'], record['closed_at']])
+                'opened_at': window['opened_at'],
+                'closed_at': window['closed_at']
+            } for window in windows],
+            'members': members.values()
+        }
+
+    def _ordered_members(self, kind, member_field, role, page_size):
+        query = self.datastore.query(kind=kind)
+        query.add_filter('course_id', '=', self.get_id())
+        query.order = [member_field]
+        for join in iter_query(query, page_size):
+            yield join[member_field], role
+
+    def iter_attendance(self, page_size=MAX_LOOKUP_BATCH):
+        """Yield a row for every student and TA in every session of the course.
+
+        Reads as it goes, so memory doesn't grow with the size of the course:
+        the members are paged by id from the join entities, merged with the
+        course's attendance records paged by user id (see index.yaml), and
+        their profiles looked up a page at a time. Only the sessions are read
+        up front. Someone who is both a student and a TA gets rows for each.
+        """
+        if not self.fetched:
+            raise ValueError('Can\'t get attendance of an unsaved course')
 
-        return details
+        windows = self.get_sessions()
+
+        query = self.datastore.query(kind='attendance_record')
+        query.add_filter('course_id', '=', self.get_id())
+        query.order = ['user_id']
+        records = iter_query(query, page_size)
+        record = next(records, None)
+
+        members = heapq.merge(
+            self._ordered_members('takes', 'student_id', 'student', page_size),
+            self._ordered_members('tas', 'ta_id', 'TA', page_size))
+        attended = (None, set())
+        while True:
+            page = list(islice(members, page_size))
+            if not page:
+                return
+
+            # straight from storage, so a big course doesn't fill the identity map
+            users = dict((user.key.id, user) for user in get_multi(
+                self.datastore, [self.datastore.key('user', id) for id in set(
+                    id for id, _ in page)]))
+            for user_id, role in page:
+                if attended[0] != user_id:
+                    while record is not None and record['user_id'] < user_id:
+                        record = next(records, None)
+                    sessions = set()
+                    while record is not None and record['user_id'] == user_id:
+                        sessions.add(record['attendance_window_id'])
+                        record = next(records, None)
+                    attended = (user_id, sessions)
+
+                user = users.get(user_id, dict())
+                for window in windows:
+                    yield OrderedDict([
+                        ('user_id', user_id),
+                        ('uni', user.get('uni')),
+                        ('name', user.get('name')),
+                        ('email', user.get('email')),
+                        ('role', role),
+                        ('session_id', window.key.id),
+                        ('opened_at', window['opened_at']),
+                        ('closed_at', window['closed_at']),
+                        ('attended', window.key.id in attended[1])
+                    ])
 
     def edit_attendance_history(self, **kwargs):
         if not self.fetched:
@@ -350,36 +908,57 @@ class Course(Model):
             if not user.tas_course(self):
                 raise ValueError('TA does not TA course')
 
-        query = self.datastore.query(kind='attendance_record')
-        query.add_filter('user_id', '=', user.get_id())
-        query.add_filter('course_id', '=', self.get_id())
-        query.add_filter('attendance_window_id', '=', kwargs['session_id'])
-        query.keys_only()
-        records = list(query.fetch())
-        record = records[0] if len(records) > 0 else None
+        keys = self._join_keys(
+            'attendance_record',
+            course_id=self.get_id(),
+            attendance_window_id=kwargs['session_id'],
+            user_id=user.get_id()
+        )
 
-        if kwargs['attended'] == (record is not None):
+        def edit():
+            records = get_multi(self.datastore, keys)
+            if kwargs['attended'] == bool(records):
+                return
+
+            if kwargs['attended']:
+                self.create_join(
+                    'attendance_record',
+                    user_id=user.get_id(),
+                    course_id=self.get_id(),
+                    attendance_window_id=kwargs['session_id']
+                )
+                self._count_attendance(user, 1)
+            else:
+                self.datastore.delete_multi([record.key for record in records])
+                self._count_attendance(user, -len(records))
+
+        self.run_in_transaction(edit)
+
+    def destroy(self, checkpoint=None, on_progress=None):
+        """Delete the course along with its attendance and join table entities.
+
+        Dependents are streamed out in batches before the course itself goes,
+        so an interrupted destroy can be finished by calling it again, or by
+        passing the last checkpoint `on_progress` was given (see
+        CascadeDeleter) to skip what's already gone.
+        """
+        if not self.fetched:
             return
 
-        if kwargs['attended']:
-            self.create_entity(
-                kind='attendance_record',
-                user_id=user.get_id(),
-                course_id=self.get_id(),
-                attendance_window_id=kwargs['session_id']
-            )
-        else:
-            self.datastore.delete_multi([r.key for r in records])
+        deleter = CascadeDeleter(
+            self.datastore,
+            ['attendance_record', 'attendance_window', 'tas', 'takes', 'teaches',
+             ShardedCounter.kind],
+            'course_id',
+            self.get_id(),
+            workers=config.CASCADE_DELETE_WORKERS,
+            checkpoint=checkpoint,
+            on_progress=on_progress
+        )
+        deleter.run()
+        self.datastore.delete(self._membership_key())
+        self.forget_entity(self._membership_key())
+        _open_sessions.discard(self.get_id())
+        _rosters.discard(self.get_id())
 
-    def destroy(self):
         super(self.__class__, self).destroy()
-
-        # clean up attendance windows, records, and join table entities
-        keys = list()
-        for kind in ['attendance_record', 'attendance_window', 'tas', 'takes', 'teaches']:
-            query = self.datastore.query(kind=kind)
-            query.add_filter('course_id', '=', self.get_id())
-            query.keys_only()
-            keys = keys + [e.key for e in list(query.fetch())]
-
-        self.datastore.delete_multi(keys)
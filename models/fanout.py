@@ -0,0 +1,69 @@
+"""Runs a request's independent storage reads at the same time.
+
+Calls handed to `gather` run on a process-wide pool of FANOUT_WORKERS
+threads, so a handful of reads that don't depend on each other take about as
+long as the slowest of them instead of their sum. Each call runs in the app
+context of the request that made it, so it shares the request's identity
+map and its storage calls count towards the request's stats.
+
+Transactions belong to the thread that opened them, so don't gather reads
+that have to happen inside one.
+"""
+
+import threading
+
+import flask
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import config
+from models import identity_map
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# set on pool threads, so a call that gathers again runs its calls inline
+# instead of waiting on a pool it's occupying
+_local = threading.local()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.FANOUT_WORKERS)
+        return _executor
+
+
+def gather(*calls):
+    """Run each of `calls`, which take no arguments, and return their results in order.
+
+    The first exception any of them raises is raised here once all are done.
+    With one call, a pool of one, or from inside a gathered call, they run
+    one after another on the calling thread.
+    """
+    if len(calls) <= 1 or config.FANOUT_WORKERS <= 1 or getattr(_local, 'worker', False):
+        return [call() for call in calls]
+
+    app = flask.current_app._get_current_object() if flask.has_app_context() else None
+    if app is not None:
+        # made now, so the calls don't each make their own
+        identity_map.current()
+        g = flask.g._get_current_object()
+
+    def run(call):
+        _local.worker = True
+        try:
+            if app is None:
+                return call()
+            context = app.app_context()
+            context.g = g
+            with context:
+                return call()
+        finally:
+            _local.worker = False
+
+    executor = _get_executor()
+    futures = [executor.submit(run, call) for call in calls]
+    wait(futures)
+    return [future.result() for future in futures]
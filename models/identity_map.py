@@ -0,0 +1,61 @@
+import threading
+
+import flask
+
+
+class IdentityMap(object):
+    """Entities already fetched during the current request, keyed by their key.
+
+    Lookups that found nothing are remembered too, so asking twice for a
+    missing entity still costs a single get. Models built lazily during the
+    request wait in `pending` until the first of them is used, then all of
+    them are fetched together.
+    """
+
+    def __init__(self):
+        self._entities = dict()
+        self._pending = list()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _identity(key):
+        return (key.kind, key.id_or_name)
+
+    def __contains__(self, key):
+        return self._identity(key) in self._entities
+
+    def get(self, key):
+        return self._entities.get(self._identity(key))
+
+    def add(self, key, entity):
+        with self._lock:
+            self._entities[self._identity(key)] = entity
+
+    def discard(self, key):
+        with self._lock:
+            self._entities.pop(self._identity(key), None)
+
+    def defer(self, model):
+        with self._lock:
+            self._pending.append(model)
+
+    def take_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, list()
+        return pending
+
+    def clear(self):
+        with self._lock:
+            self._entities.clear()
+            del self._pending[:]
+
+
+def current():
+    """Return the identity map of the request being served, if there is one."""
+    if not flask.has_app_context():
+        return None
+
+    identity_map = getattr(flask.g, '_identity_map', None)
+    if identity_map is None:
+        identity_map = flask.g._identity_map = IdentityMap()
+    return identity_map
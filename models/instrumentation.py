@@ -0,0 +1,276 @@
+"""Counts and times the storage calls each request makes.
+
+Every client the pool hands out is wrapped in an InstrumentedClient, which
+records gets, queries, puts, deletes and transactions into the stats of the
+request being served, along with the write confirmation polls. The app turns
+those into a debug header, a log line per request and the `/_stats` page.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+import flask
+
+
+GET = 'get'
+QUERY = 'query'
+PUT = 'put'
+DELETE = 'delete'
+ALLOCATE = 'allocate'
+BEGIN = 'begin'
+COMMIT = 'commit'
+POLL = 'poll'
+OPERATIONS = (GET, QUERY, PUT, DELETE, ALLOCATE, BEGIN, COMMIT, POLL)
+
+logger = logging.getLogger(__name__)
+
+
+class RpcBudgetExceeded(Exception):
+    pass
+
+
+class RequestStats(object):
+    """The storage calls made while serving one request, and the time they took.
+
+    With a `budget`, the call that takes the request over it raises
+    RpcBudgetExceeded, so a regression fails loudly instead of just slowly.
+    Confirmation polls are reported but their lookups are what's counted.
+    """
+
+    def __init__(self, budget=None, clock=time.time):
+        self.budget = budget
+        self.started = clock()
+        self.counts = dict.fromkeys(OPERATIONS, 0)
+        self.elapsed = dict.fromkeys(OPERATIONS, 0.0)
+        self._lock = threading.Lock()
+
+    @property
+    def calls(self):
+        return sum(count for operation, count in self.counts.items() if operation != POLL)
+
+    @property
+    def storage_time(self):
+        return sum(self.elapsed.values())
+
+    def record(self, operation, elapsed=0.0):
+        with self._lock:
+            self.counts[operation] += 1
+            self.elapsed[operation] += elapsed
+            calls = self.calls
+
+        if self.budget is not None and operation != POLL and calls > self.budget:
+            raise RpcBudgetExceeded('{0} storage calls, over the budget of {1}: {2}'.format(
+                calls, self.budget, self.summary()))
+
+    def add_time(self, operation, elapsed):
+        with self._lock:
+            self.elapsed[operation] += elapsed
+
+    def summary(self):
+        """A compact one-line form, e.g. for a response header."""
+        with self._lock:
+            return ';'.join(['{0}={1}'.format(operation, self.counts[operation])
+                             for operation in OPERATIONS] +
+                            ['storage_ms={0:.1f}'.format(self.storage_time * 1000)])
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'counts': dict(self.counts),
+                'storage_ms': round(self.storage_time * 1000, 3)
+            }
+
+
+def start(budget=None):
+    """Begin collecting stats for the request being served."""
+    stats = flask.g._rpc_stats = RequestStats(budget)
+    return stats
+
+
+def current():
+    """Return the stats of the request being served, if there is one."""
+    if not flask.has_app_context():
+        return None
+    return getattr(flask.g, '_rpc_stats', None)
+
+
+def record(operation, elapsed=0.0):
+    stats = current()
+    if stats is not None:
+        stats.record(operation, elapsed)
+
+
+class _Timed(object):
+    def __init__(self, operation):
+        self.operation = operation
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.operation, time.time() - self.started)
+
+
+class InstrumentedResults(object):
+    """Query results that charge the time spent fetching pages to the query."""
+
+    def __init__(self, results):
+        self._results = results
+
+    def __iter__(self):
+        iterator = iter(self._results)
+        while True:
+            started = time.time()
+            try:
+                entity = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                stats = current()
+                if stats is not None:
+                    stats.add_time(QUERY, time.time() - started)
+            yield entity
+
+    def __getattr__(self, name):
+        return getattr(self._results, name)
+
+
+class InstrumentedQuery(object):
+    def __init__(self, query):
+        self.__dict__['_query'] = query
+
+    def fetch(self, *args, **kwargs):
+        with _Timed(QUERY):
+            results = self._query.fetch(*args, **kwargs)
+        return InstrumentedResults(results)
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._query, name, value)
+
+
+class InstrumentedTransaction(object):
+    def __init__(self, transaction):
+        self._transaction = transaction
+
+    def __enter__(self):
+        with _Timed(BEGIN):
+            self._transaction.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with _Timed(COMMIT):
+            return self._transaction.__exit__(exc_type, exc_value, traceback)
+
+
+class InstrumentedClient(object):
+    """Wraps a storage client, recording each call into the current request's stats."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def get(self, key, *args, **kwargs):
+        with _Timed(GET):
+            return self._client.get(key, *args, **kwargs)
+
+    def get_multi(self, keys, *args, **kwargs):
+        with _Timed(GET):
+            return self._client.get_multi(keys, *args, **kwargs)
+
+    def put(self, entity):
+        with _Timed(PUT):
+            return self._client.put(entity)
+
+    def put_multi(self, entities):
+        with _Timed(PUT):
+            return self._client.put_multi(entities)
+
+    def delete(self, key):
+        with _Timed(DELETE):
+            return self._client.delete(key)
+
+    def delete_multi(self, keys):
+        with _Timed(DELETE):
+            return self._client.delete_multi(keys)
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        with _Timed(ALLOCATE):
+            return self._client.allocate_ids(incomplete_key, num_ids)
+
+    def query(self, *args, **kwargs):
+        return InstrumentedQuery(self._client.query(*args, **kwargs))
+
+    def transaction(self):
+        return InstrumentedTransaction(self._client.transaction())
+
+    def get_members(self, *args, **kwargs):
+        with _Timed(QUERY):
+            return self._client.get_members(*args, **kwargs)
+
+    def get_attendance_details(self, *args, **kwargs):
+        with _Timed(QUERY):
+            return self._client.get_attendance_details(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def percentile(values, fraction):
+    """The nearest-rank percentile of `values`, e.g. fraction=0.99 for p99."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+class EndpointStats(object):
+    """Rolling latency and storage call figures for the last `window` requests per endpoint."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._samples = dict()
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, latency, stats):
+        with self._lock:
+            samples = self._samples.setdefault(endpoint, deque(maxlen=self.window))
+            samples.append((latency, stats.calls, stats.storage_time))
+
+    def summary(self):
+        with self._lock:
+            samples = dict((endpoint, list(s)) for endpoint, s in self._samples.items())
+
+        def distribution(values, scale=None):
+            return dict(('p{0}'.format(int(fraction * 100)),
+                         percentile(values, fraction) if scale is None
+                         else round(percentile(values, fraction) * scale, 3))
+                        for fraction in (0.5, 0.9, 0.99))
+
+        summary = dict()
+        for endpoint, rows in samples.items():
+            latencies, calls, storage_times = zip(*rows)
+            summary[endpoint] = {
+                'requests': len(rows),
+                'latency_ms': distribution(latencies, 1000),
+                'storage_ms': distribution(storage_times, 1000),
+                'calls': dict(distribution(calls), max=max(calls))
+            }
+        return summary
+
+
+def log_request(endpoint, method, status, latency, stats):
+    logger.info(json.dumps({
+        'event': 'request',
+        'endpoint': endpoint,
+        'method': method,
+        'status': status,
+        'latency_ms': round(latency * 1000, 3),
+        'storage': stats.to_dict()
+    }, sort_keys=True))
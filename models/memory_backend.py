@@ -0,0 +1,333 @@
+"""A storage backend that keeps every entity in process memory.
+
+Meant for tests and offline benchmarks: there is no network and queries are
+strongly consistent, so the app runs at memory speed. Equality filters on the
+fields the models filter by are answered from per-kind indexes; everything
+else is a scan of the kind. All clients of a project in the process share one
+store, which `reset()` empties.
+"""
+
+import functools
+import itertools
+import operator
+import threading
+from uuid import uuid4
+
+import cachetools
+from google.cloud import datastore
+from google.cloud.exceptions import Conflict
+
+from models.storage import StorageClient
+
+
+# properties the models filter on, whose equality filters are answered from an index
+INDEXED_FIELDS = (
+    'course_id', 'student_id', 'ta_id', 'teacher_id', 'user_id', 'uni', 'email', 'closed_at')
+
+OPERATORS = {
+    '=': operator.eq,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge
+}
+
+
+def _stored(value):
+    # Datastore hands every integer back as a long
+    if isinstance(value, list):
+        return [_stored(item) for item in value]
+    if isinstance(value, int) and not isinstance(value, bool):
+        return long(value)
+    return value
+
+
+def _copy(entity, keys_only=False):
+    copy = datastore.Entity(
+        key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+    if not keys_only:
+        for name, value in entity.items():
+            copy[name] = _stored(value)
+    return copy
+
+
+def _values(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _ordered(value):
+    # Datastore orders values of different types by type first
+    if value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (3, value)
+    if isinstance(value, (int, long, float)):
+        return (1, value)
+    if hasattr(value, 'isoformat'):
+        return (2, value)
+    if isinstance(value, basestring):
+        return (4, value)
+    return (5, value)
+
+
+@functools.total_ordering
+class _Descending(object):
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class Store(object):
+    """The entities of one project, with an index per kind and indexed field."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self._entities = dict()
+        self._versions = dict()
+        self._kinds = dict()
+        self._indexes = dict()
+        self._ids = itertools.count(1)
+        self._cursors = cachetools.LRUCache(maxsize=10000)
+
+    def allocate_id(self):
+        with self.lock:
+            return next(self._ids)
+
+    def version(self, path):
+        return self._versions.get(path, 0)
+
+    def get(self, path):
+        return self._entities.get(path)
+
+    def _index(self, path, entity, add):
+        for field in INDEXED_FIELDS:
+            if field not in entity:
+                continue
+            index = self._indexes.setdefault((entity.key.kind, field), dict())
+            for value in _values(entity[field]):
+                paths = index.setdefault(value, set())
+                if add:
+                    paths.add(path)
+                else:
+                    paths.discard(path)
+
+    def _remove(self, path):
+        old = self._entities.pop(path, None)
+        if old is not None:
+            self._index(path, old, add=False)
+            self._kinds[old.key.kind].discard(path)
+        self._versions[path] = self.version(path) + 1
+
+    def write(self, puts=(), deletes=()):
+        """Apply the puts and deletes at once. Callers pass copies they won't touch again."""
+        with self.lock:
+            for key in deletes:
+                self._remove(key.flat_path)
+            for entity in puts:
+                path = entity.key.flat_path
+                self._remove(path)
+                self._entities[path] = entity
+                self._kinds.setdefault(entity.key.kind, set()).add(path)
+                self._index(path, entity, add=True)
+
+    def _candidates(self, kind, filters):
+        paths = self._kinds.get(kind, set())
+        for name, op, value in filters:
+            if op == '=' and name in INDEXED_FIELDS:
+                indexed = self._indexes.get((kind, name), dict()).get(value, set())
+                if len(indexed) < len(paths):
+                    paths = indexed
+        return paths
+
+    def query(self, query, limit, start_cursor):
+        with self.lock:
+            def matches(entity):
+                for name, op, value in query.filters:
+                    if name not in entity or not any(
+                            OPERATORS[op](_ordered(v), _ordered(value))
+                            for v in _values(entity[name])):
+                        return False
+                return all(name.lstrip('-') in entity for name in query.order)
+
+            def position(entity):
+                return tuple(
+                    _Descending(_ordered(entity[name[1:]])) if name.startswith('-')
+                    else _ordered(entity[name])
+                    for name in query.order
+                ) + (entity.key.flat_path,)
+
+            entities = [self._entities[path]
+                        for path in self._candidates(query.kind, query.filters)]
+            entities = sorted((entity for entity in entities if matches(entity)), key=position)
+
+            if start_cursor is not None:
+                if start_cursor not in self._cursors:
+                    raise ValueError('Unknown cursor ' + repr(start_cursor))
+                after = self._cursors[start_cursor]
+                entities = [entity for entity in entities if position(entity) > after]
+
+            next_page_token = None
+            if limit is not None and len(entities) > limit:
+                entities = entities[:limit]
+                next_page_token = uuid4().hex
+                self._cursors[next_page_token] = position(entities[-1])
+
+            return Results(
+                [_copy(entity, keys_only=query.is_keys_only) for entity in entities],
+                next_page_token
+            )
+
+
+class Results(object):
+    """One page of query results, like the iterator Datastore's fetch returns."""
+
+    def __init__(self, entities, next_page_token):
+        self._entities = entities
+        self.next_page_token = next_page_token
+
+    def __iter__(self):
+        return iter(self._entities)
+
+
+class Query(object):
+    def __init__(self, client, kind):
+        self._client = client
+        self.kind = kind
+        self.filters = list()
+        self.order = list()
+        self.is_keys_only = False
+
+    def add_filter(self, name, op, value):
+        if op not in OPERATORS:
+            raise ValueError('Unsupported filter operator ' + repr(op))
+        self.filters.append((name, op, value))
+        return self
+
+    def keys_only(self):
+        self.is_keys_only = True
+
+    def fetch(self, limit=None, start_cursor=None):
+        return self._client._store.query(self, limit, start_cursor)
+
+
+class Transaction(object):
+    """Buffers writes until the block exits, then commits them unless what it read changed."""
+
+    def __init__(self, client):
+        self._client = client
+        self._reads = dict()
+        self._puts = list()
+        self._deletes = list()
+        self._outer = None
+
+    def read(self, path, version):
+        self._reads.setdefault(path, version)
+
+    def put(self, entity):
+        self._puts.append(entity)
+
+    def delete(self, key):
+        self._deletes.append(key)
+
+    def commit(self):
+        store = self._client._store
+        with store.lock:
+            for path, version in self._reads.items():
+                if store.version(path) != version:
+                    raise Conflict('Transaction collided on ' + repr(path))
+            store.write(self._puts, self._deletes)
+
+    def __enter__(self):
+        self._outer = self._client.current_transaction
+        self._client._local.transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._client._local.transaction = self._outer
+        if exc_type is None:
+            self.commit()
+
+
+class Client(StorageClient):
+    def __init__(self, project):
+        super(Client, self).__init__(project)
+        self._store = get_store(project)
+        self._local = threading.local()
+
+    @property
+    def current_transaction(self):
+        return getattr(self._local, 'transaction', None)
+
+    def get_multi(self, keys):
+        transaction = self.current_transaction
+        found = list()
+        with self._store.lock:
+            for key in keys:
+                path = key.flat_path
+                if transaction is not None:
+                    transaction.read(path, self._store.version(path))
+                entity = self._store.get(path)
+                if entity is not None:
+                    found.append(_copy(entity))
+        return found
+
+    def put_multi(self, entities):
+        copies = list()
+        for entity in entities:
+            if entity.key.is_partial:
+                entity.key = entity.key.completed_key(self._store.allocate_id())
+            copies.append(_copy(entity))
+
+        transaction = self.current_transaction
+        if transaction is None:
+            self._store.write(puts=copies)
+        else:
+            for copy in copies:
+                transaction.put(copy)
+
+    def delete_multi(self, keys):
+        transaction = self.current_transaction
+        if transaction is None:
+            self._store.write(deletes=keys)
+        else:
+            for key in keys:
+                transaction.delete(key)
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        return [incomplete_key.completed_key(self._store.allocate_id()) for _ in range(num_ids)]
+
+    def query(self, kind=None):
+        return Query(self, kind)
+
+    def transaction(self):
+        return Transaction(self)
+
+
+_stores = dict()
+_stores_lock = threading.Lock()
+
+
+def get_store(project):
+    with _stores_lock:
+        if project not in _stores:
+            _stores[project] = Store()
+        return _stores[project]
+
+
+def reset():
+    """Forget every entity of every project."""
+    with _stores_lock:
+        for store in _stores.values():
+            with store.lock:
+                store.clear()
@@ -0,0 +1,158 @@
+"""One-shot data migrations. Run them from the repository root, e.g.
+
+    python -m models.migrations join-keys --dry-run
+    python -m models.migrations join-keys
+    python -m models.migrations membership-summaries
+    python -m models.migrations attendance-counters
+    python -m models.migrations user-indexes
+"""
+
+import sys
+
+from google.cloud import datastore
+from models import client_pool, courses_model, users_model
+from models.model import JOIN_KEY_FIELDS, MAX_MUTATION_BATCH, join_key
+
+
+def migrate_join_keys(client, dry_run=False):
+    """Move join entities saved under allocated ids to their deterministic keys.
+
+    Duplicate rows for the same pair collapse into one. Entities that already
+    have deterministic keys are left alone, so this is safe to re-run.
+    Returns the number of entities moved per kind.
+    """
+    moved = dict()
+    for kind in sorted(JOIN_KEY_FIELDS):
+        moved[kind] = 0
+        cursor = None
+        while True:
+            query = client.query(kind=kind)
+            results = query.fetch(limit=MAX_MUTATION_BATCH, start_cursor=cursor)
+            page = list(results)
+
+            legacy = [entity for entity in page if entity.key.name is None]
+            if legacy and not dry_run:
+                renamed = dict()
+                for entity in legacy:
+                    key = join_key(client, kind, **entity)
+                    renamed.setdefault(key.name, datastore.Entity(key=key)).update(entity)
+                client.put_multi(renamed.values())
+                client.delete_multi([entity.key for entity in legacy])
+            moved[kind] += len(legacy)
+
+            if len(page) < MAX_MUTATION_BATCH or results.next_page_token is None:
+                break
+            cursor = results.next_page_token
+
+    return moved
+
+
+def rebuild_membership_summaries(client):
+    """Rebuild every course's membership summary from its join entities.
+
+    Run it after join-keys, and whenever summaries may have drifted, e.g.
+    after running with MEMBERSHIP_SUMMARY off. The joins are read with
+    eventually consistent queries, so run it once joins written just before
+    have had time to show up. Returns the number of courses.
+    """
+    rebuilt = 0
+    cursor = None
+    while True:
+        query = client.query(kind='course')
+        query.keys_only()
+        results = query.fetch(limit=MAX_MUTATION_BATCH, start_cursor=cursor)
+        keys = [entity.key for entity in results]
+
+        client.delete_multi([client.key('course_membership', key.id) for key in keys])
+        for key in keys:
+            courses_model.Course(id=key.id).get_membership_summary()
+        rebuilt += len(keys)
+
+        if len(keys) < MAX_MUTATION_BATCH or results.next_page_token is None:
+            break
+        cursor = results.next_page_token
+
+    return rebuilt
+
+
+def rebuild_attendance_counters(client):
+    """Recount every course's sessions and attendance; returns the number of courses.
+
+    Courses that were never counted are also recounted the first time their
+    counts are read, so this only spares those first reads, and fixes
+    counts that drifted.
+    """
+    rebuilt = 0
+    cursor = None
+    while True:
+        query = client.query(kind='course')
+        query.keys_only()
+        results = query.fetch(limit=MAX_MUTATION_BATCH, start_cursor=cursor)
+        keys = [entity.key for entity in results]
+
+        for key in keys:
+            courses_model.Course(id=key.id).rebuild_counters()
+        rebuilt += len(keys)
+
+        if len(keys) < MAX_MUTATION_BATCH or results.next_page_token is None:
+            break
+        cursor = results.next_page_token
+
+    return rebuilt
+
+
+def rebuild_user_indexes(client):
+    """Point the UNI and email index entities at every user; returns the number of users.
+
+    Run it once for users saved before the indexes existed, then turn
+    LEGACY_USERS off. If two users share a value, the index ends up pointing
+    at one of them.
+    """
+    indexed = 0
+    cursor = None
+    while True:
+        query = client.query(kind='user')
+        results = query.fetch(limit=MAX_MUTATION_BATCH, start_cursor=cursor)
+        users = list(results)
+
+        users_model.save_indexes(client, users)
+        indexed += len(users)
+
+        if len(users) < MAX_MUTATION_BATCH or results.next_page_token is None:
+            break
+        cursor = results.next_page_token
+
+    return indexed
+
+
+def main(argv):
+    if argv == ['membership-summaries']:
+        print 'rebuilt {0} course summaries'.format(
+            rebuild_membership_summaries(client_pool.get_client()))
+        return 0
+
+    if argv == ['attendance-counters']:
+        print 'recounted attendance of {0} courses'.format(
+            rebuild_attendance_counters(client_pool.get_client()))
+        return 0
+
+    if argv == ['user-indexes']:
+        print 'indexed {0} users'.format(rebuild_user_indexes(client_pool.get_client()))
+        return 0
+
+    if not argv or argv[0] != 'join-keys':
+        print 'usage: python -m models.migrations join-keys [--dry-run]'
+        print '       python -m models.migrations membership-summaries'
+        print '       python -m models.migrations attendance-counters'
+        print '       python -m models.migrations user-indexes'
+        return 1
+
+    dry_run = '--dry-run' in argv[1:]
+    moved = migrate_join_keys(client_pool.get_client(), dry_run=dry_run)
+    for kind in sorted(moved):
+        print '{0}: {1} {2}'.format(kind, 'would move' if dry_run else 'moved', moved[kind])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
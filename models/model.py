@@ -1,10 +1,215 @@
 from google.cloud import datastore
+from google.cloud.exceptions import Conflict
+from models import client_pool, consistency, identity_map
+import config
 
 
+# Datastore won't look up more keys, or commit more mutations, than this in one call
+MAX_LOOKUP_BATCH = 1000
+MAX_MUTATION_BATCH = 500
+
+# how many times a transaction that collided with another is retried
+TRANSACTION_RETRIES = 3
+
+# join entities are named after the ids they join, so checking membership is a
+# strongly consistent key lookup instead of an eventually consistent query
+JOIN_KEY_FIELDS = {
+    'takes': ('course_id', 'student_id'),
+    'tas': ('course_id', 'ta_id'),
+    'teaches': ('course_id', 'teacher_id'),
+    'attendance_record': ('course_id', 'attendance_window_id', 'user_id')
+}
+
+
+def join_key(client, kind, **ids):
+    """The key of the `kind` join entity between the given ids, e.g. takes '12:34'."""
+    return client.key(kind, ':'.join(str(ids[field]) for field in JOIN_KEY_FIELDS[kind]))
+
+
+def legacy_join(client, kind, **ids):
+    """Find a `kind` join saved under an allocated id, before join keys existed.
+
+    Key lookups can't see those, so callers that missed on the join key ask
+    here. Answers None without a query once LEGACY_JOINS is off, i.e. after
+    `python -m models.migrations join-keys` has moved them.
+    """
+    if not config.LEGACY_JOINS:
+        return None
+
+    query = client.query(kind=kind)
+    for field in JOIN_KEY_FIELDS[kind]:
+        query.add_filter(field, '=', ids[field])
+    # the join under its join key turns up too
+    for join in query.fetch():
+        if join.key.name is None:
+            return join
+    return None
+
+
+def get_join(client, kind, **ids):
+    """The `kind` join between `ids`, under its join key or else a legacy_join."""
+    join = client.get(join_key(client, kind, **ids))
+    if join is None:
+        join = legacy_join(client, kind, **ids)
+    return join
+
+
+def iter_query(query, page_size=MAX_LOOKUP_BATCH):
+    """Yield every result of `query`, fetching a page of `page_size` at a time by cursor."""
+    cursor = None
+    while True:
+        results = query.fetch(limit=page_size, start_cursor=cursor)
+        page = list(results)
+        for entity in page:
+            yield entity
+
+        if len(page) < page_size or results.next_page_token is None:
+            return
+        cursor = results.next_page_token
+
+
+def _identity(key):
+    return (key.kind, key.id_or_name)
+
+
+def get_multi(client, keys):
+    """Look up any number of keys straight from Datastore, in batches it accepts."""
+    entities = list()
+    for start in range(0, len(keys), MAX_LOOKUP_BATCH):
+        entities.extend(client.get_multi(keys[start:start + MAX_LOOKUP_BATCH]))
+    return entities
+
+
+def load_entities(client, keys):
+    """Get the entities for `keys` in as few batched lookups as possible.
+
+    Goes through the request's identity map when there is one. Returns a list
+    parallel to `keys`, with None for keys that don't exist.
+    """
+    entities = identity_map.current()
+    found = dict()
+    missing = list()
+    for key in keys:
+        if _identity(key) in found:
+            continue
+        if entities is not None and key in entities:
+            found[_identity(key)] = entities.get(key)
+        else:
+            found[_identity(key)] = None
+            missing.append(key)
+
+    for entity in get_multi(client, missing):
+        found[_identity(entity.key)] = entity
+
+    if entities is not None:
+        for key in missing:
+            entities.add(key, found[_identity(key)])
+
+    return [found[_identity(key)] for key in keys]
+
+
+def run_in_transaction(client, work):
+    """Run `work()` in a transaction, retrying it if it collides with another one."""
+    for attempt in range(TRANSACTION_RETRIES + 1):
+        try:
+            with client.transaction():
+                return work()
+        except Conflict:
+            if attempt == TRANSACTION_RETRIES:
+                raise
+
+
+def load_models(models):
+    """Fetch the entities of any lazily built `models` in one batched lookup.
+
+    Models still waiting to be loaded elsewhere in the request come along too.
+    """
+    entities = identity_map.current()
+    pending = [model for model in models if not model.loaded]
+    if entities is not None:
+        pending.extend(model for model in entities.take_pending()
+                       if not model.loaded and model not in pending)
+    if not pending:
+        return
+
+    loaded = load_entities(pending[0].datastore, [model._pending_key for model in pending])
+    for model, entity in zip(pending, loaded):
+        model._resolve(entity)
+
 
 class Model(object):
+    # a model built from just an id keeps the key here until it's first used
+    _pending_key = None
+    _fallback = None
+    _model = None
+    _fetched = False
+
     def get_client(self):
-        return datastore.Client('coms4156-168718')
+        return client_pool.get_client()
+
+    @property
+    def model(self):
+        if self._pending_key is not None:
+            load_models([self])
+        return self._model
+
+    @model.setter
+    def model(self, value):
+        self._pending_key = None
+        self._model = value
+
+    @property
+    def fetched(self):
+        if self._pending_key is not None:
+            load_models([self])
+        return self._fetched
+
+    @fetched.setter
+    def fetched(self, value):
+        self._fetched = value
+
+    @property
+    def loaded(self):
+        """Whether the entity has been looked up, so using the model costs nothing."""
+        return self._pending_key is None
+
+    def defer_load(self, key, fallback):
+        """Look `key` up when the model is first used, not now.
+
+        If it doesn't exist the model is `fallback`, unfetched, as if it had
+        been looked up eagerly. The lookup is batched with the other models
+        waiting in the request.
+        """
+        self._pending_key = key
+        self._fallback = fallback
+        entities = identity_map.current()
+        if entities is not None:
+            entities.defer(self)
+
+    def _resolve(self, entity):
+        if entity is None:
+            self.model = self._fallback
+            self.fetched = False
+        else:
+            self.model = entity
+            self.fetched = True
+
+    @classmethod
+    def from_entity(cls, entity):
+        """Wrap an already fetched entity without another round trip."""
+        instance = cls.__new__(cls)
+        instance.datastore = instance.get_client()
+        instance.model = entity
+        instance.fetched = True
+        return instance
+
+    @classmethod
+    def get_multi(cls, ids):
+        """Fetch the models with the given ids in batched lookups, skipping missing ones."""
+        client = client_pool.get_client()
+        keys = [client.key(cls.kind, id) for id in ids]
+        return [cls.from_entity(entity) for entity in load_entities(client, keys)
+                if entity is not None]
 
     def get(self, key, fallback=None):
         return self.model.get(key, fallback)
@@ -13,32 +218,90 @@ class Model(object):
         return self.get_key().id
 
     def get_key(self):
+        if self._pending_key is not None:
+            return self._pending_key
         return self.model.key
 
     def destroy(self):
         if not self.fetched:
             return
 
-        self.datastore.delete(self.get_key())
+        key = self.get_key()
+        self.datastore.delete(key)
+        self.forget_entity(key)
 
-        while self.datastore.get(self.get_key()):
-            pass
+        self.confirm_write('destroy', lambda: not self.datastore.get(key))
 
     def update(self, **kwargs):
         self.model.update(kwargs)
         self.datastore.put(self.model)
+        self.forget_entity(self.get_key())
 
-    def create_entity(self, **kwargs):
-        key = self.datastore.key(kwargs['kind'])
+    def build_entity(self, key, **properties):
         entity = datastore.Entity(key=key)
-        kwargs.pop('kind')
-        entity.update(kwargs)
+        entity.update(properties)
+        return entity
+
+    def create_entity(self, **kwargs):
+        key = self.datastore.key(kwargs.pop('kind'))
+        entity = self.build_entity(key, **kwargs)
         self.datastore.put(entity)
+        self.forget_entity(entity.key)
 
         # datastore is really annoying and it seems it doesn't always update
         # immediately, so if we don't do this then sometimes querying the key
         # immediately after calling this function won't work
-        while not self.datastore.get(entity.key):
-            pass
+        self.confirm_write('create_entity', lambda: self.datastore.get(entity.key))
 
         return entity.key
+
+    def create_join(self, kind, **ids):
+        """Save the `kind` join entity between the given ids; returns its key."""
+        key = join_key(self.datastore, kind, **ids)
+        self.datastore.put(self.build_entity(key, **ids))
+        return key
+
+    def create_entities(self, kind, rows):
+        """Create one `kind` entity per dict in `rows` with batched puts; returns their keys.
+
+        Join kinds get their deterministic keys, everything else fresh ids.
+        """
+        entities = list()
+        for row in rows:
+            if kind in JOIN_KEY_FIELDS:
+                key = join_key(self.datastore, kind, **row)
+            else:
+                key = self.datastore.key(kind)
+            entities.append(self.build_entity(key, **row))
+
+        for start in range(0, len(entities), MAX_MUTATION_BATCH):
+            self.datastore.put_multi(entities[start:start + MAX_MUTATION_BATCH])
+
+        return [entity.key for entity in entities]
+
+    def load_entity(self, key):
+        """Get an entity, going through the request's identity map if there is one."""
+        entities = identity_map.current()
+        if entities is None:
+            return self.datastore.get(key)
+
+        if key not in entities:
+            entities.add(key, self.datastore.get(key))
+        return entities.get(key)
+
+    def remember_entity(self, entity):
+        entities = identity_map.current()
+        if entities is not None and entity is not None:
+            entities.add(entity.key, entity)
+        return entity
+
+    def forget_entity(self, key):
+        entities = identity_map.current()
+        if entities is not None:
+            entities.discard(key)
+
+    def run_in_transaction(self, work):
+        return run_in_transaction(self.datastore, work)
+
+    def confirm_write(self, operation, check, lookup=None):
+        return consistency.confirm(operation, check, lookup)
@@ -0,0 +1,448 @@
+"""A storage backend on a relational database, run locally with SQLite.
+
+Every kind the models use has a table with a column per property they filter,
+order or join on, and indexes for those access paths; anything else an entity
+carries is pickled into its `extra` column. Kinds without a table of their own
+get one with just the key and `extra`. Because the rows are relational, the
+client also answers the models' joins, such as a course's roster or a
+student's attendance details, with one statement each.
+"""
+
+import base64
+import json
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from google.cloud import datastore
+from google.cloud.exceptions import Conflict
+
+from models.storage import StorageClient
+
+
+# SQLite can't bind more parameters than this to one statement
+MAX_PARAMETERS = 500
+
+# kind -> its columns and their types, besides the key and `extra`
+TABLES = OrderedDict([
+    ('user', OrderedDict([
+        ('name', 'TEXT'), ('email', 'TEXT'), ('uni', 'TEXT'), ('teacher', 'BOOLEAN')])),
+    ('user_by_uni', OrderedDict([('user_id', 'INTEGER')])),
+    ('user_by_email', OrderedDict([('user_id', 'INTEGER')])),
+    ('course', OrderedDict([('name', 'TEXT')])),
+    ('takes', OrderedDict([('course_id', 'INTEGER'), ('student_id', 'INTEGER')])),
+    ('tas', OrderedDict([('course_id', 'INTEGER'), ('ta_id', 'INTEGER')])),
+    ('teaches', OrderedDict([('course_id', 'INTEGER'), ('teacher_id', 'INTEGER')])),
+    ('attendance_window', OrderedDict([
+        ('course_id', 'INTEGER'), ('opened_at', 'TIMESTAMP'), ('closed_at', 'TIMESTAMP'),
+        ('secret', 'INTEGER')])),
+    ('attendance_record', OrderedDict([
+        ('course_id', 'INTEGER'), ('attendance_window_id', 'INTEGER'), ('user_id', 'INTEGER')])),
+    ('counter_shard', OrderedDict([('course_id', 'INTEGER'), ('count', 'INTEGER')]))
+])
+
+# columns whose NULL means a property set to None rather than a missing one
+NULLABLE = {
+    'attendance_window': ('closed_at',)
+}
+
+INDEXES = [
+    ('user', ('uni',)),
+    ('user', ('email',)),
+    ('takes', ('course_id', 'student_id')),
+    ('takes', ('student_id',)),
+    ('tas', ('course_id', 'ta_id')),
+    ('tas', ('ta_id',)),
+    ('teaches', ('course_id', 'teacher_id')),
+    ('teaches', ('teacher_id',)),
+    ('attendance_window', ('course_id', 'opened_at', 'closed_at')),
+    ('attendance_window', ('course_id', 'closed_at')),
+    ('attendance_window', ('closed_at',)),
+    ('attendance_record', ('course_id', 'user_id')),
+    ('attendance_record', ('user_id', 'course_id', 'attendance_window_id')),
+    ('counter_shard', ('course_id',))
+]
+
+# join kind -> the column naming the member on the other end
+MEMBER_FIELDS = {
+    'takes': 'student_id',
+    'tas': 'ta_id',
+    'teaches': 'teacher_id'
+}
+
+OPERATORS = ('=', '<', '<=', '>', '>=')
+
+_local = threading.local()
+
+
+def _table(kind):
+    return '"{0}"'.format(kind)
+
+
+def _column(name):
+    # rowid is SQLite's own row number, the tiebreaker that keeps paging stable
+    return name if name == 'rowid' else '"{0}"'.format(name)
+
+
+def _columns(kind):
+    return TABLES.get(kind, OrderedDict())
+
+
+def _read(value, column_type):
+    # give values back the way Datastore does
+    if value is None:
+        return None
+    if column_type == 'BOOLEAN':
+        return bool(value)
+    if column_type == 'INTEGER':
+        return long(value)
+    if column_type == 'TEXT':
+        return unicode(value)
+    return value
+
+
+def _entity(kind, row, keys_only=False):
+    if row['key_id'] is not None:
+        key = datastore.Key(kind, row['key_id'], project=row['project'])
+    else:
+        key = datastore.Key(kind, row['key_name'], project=row['project'])
+    entity = datastore.Entity(key=key)
+    if keys_only:
+        return entity
+
+    if row['extra'] is not None:
+        entity.update(pickle.loads(str(row['extra'])))
+    for column, column_type in _columns(kind).items():
+        value = row[column]
+        if value is not None or column in NULLABLE.get(kind, ()):
+            entity[column] = _read(value, column_type)
+    return entity
+
+
+def _encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position, default=str))
+
+
+def _decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('Malformed cursor ' + repr(cursor))
+
+
+class Results(object):
+    """One page of query results, like the iterator Datastore's fetch returns."""
+
+    def __init__(self, entities, next_page_token):
+        self._entities = entities
+        self.next_page_token = next_page_token
+
+    def __iter__(self):
+        return iter(self._entities)
+
+
+class Query(object):
+    def __init__(self, client, kind):
+        self._client = client
+        self.kind = kind
+        self.filters = list()
+        self.order = list()
+        self.is_keys_only = False
+
+    def add_filter(self, name, op, value):
+        if op not in OPERATORS:
+            raise ValueError('Unsupported filter operator ' + repr(op))
+        if name not in _columns(self.kind):
+            raise ValueError('Can\'t filter {0} by {1}, it has no such column'.format(
+                self.kind, name))
+        self.filters.append((name, op, value))
+        return self
+
+    def keys_only(self):
+        self.is_keys_only = True
+
+    def fetch(self, limit=None, start_cursor=None):
+        return self._client._query(self, limit, start_cursor)
+
+
+class Transaction(object):
+    """Runs the block's reads and writes in one database transaction.
+
+    SQLite lets one writer in at a time, so a transaction that can't get
+    the database before the timeout raises Conflict and is retried like a
+    Datastore collision. Transactions entered inside one join it.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._joined = False
+
+    def __enter__(self):
+        if self._client.current_transaction is not None:
+            self._joined = True
+            return self
+
+        try:
+            self._client._connection().execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            raise Conflict('Couldn\'t start a transaction: ' + str(e))
+        self._client._state()['transaction'] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._joined:
+            return
+
+        self._client._state()['transaction'] = None
+        connection = self._client._connection()
+        if exc_type is not None:
+            connection.execute('ROLLBACK')
+            return
+
+        try:
+            connection.execute('COMMIT')
+        except sqlite3.OperationalError as e:
+            connection.execute('ROLLBACK')
+            raise Conflict('Couldn\'t commit a transaction: ' + str(e))
+
+
+class Client(StorageClient):
+    supports_joins = True
+
+    def __init__(self, project, database, timeout=5.0):
+        super(Client, self).__init__(project)
+        self.database = database
+        self.timeout = timeout
+        self._tables = set()
+        self._tables_lock = threading.Lock()
+
+    def _state(self):
+        # every client of a database shares the thread's connection, so writes
+        # made through any of them join the transaction in progress
+        states = _local.__dict__.setdefault('databases', dict())
+        return states.setdefault(self.database, {'connection': None, 'transaction': None})
+
+    def _connection(self):
+        state = self._state()
+        connection = state['connection']
+        if connection is None:
+            # statements autocommit unless they run inside an explicit transaction
+            connection = sqlite3.connect(
+                self.database,
+                timeout=self.timeout,
+                isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES
+            )
+            connection.row_factory = sqlite3.Row
+            connection.text_factory = unicode
+            state['connection'] = connection
+            self._create_schema(connection)
+        return connection
+
+    def _create_schema(self, connection):
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS allocated_id (id INTEGER PRIMARY KEY AUTOINCREMENT)')
+        for kind in TABLES:
+            self._create_table(connection, kind)
+        for kind, columns in INDEXES:
+            connection.execute('CREATE INDEX IF NOT EXISTS "{0}_{1}" ON {2} ({3})'.format(
+                kind, '_'.join(columns), _table(kind), ', '.join(columns)))
+
+    def _create_table(self, connection, kind):
+        columns = ''.join(', "{0}" {1}'.format(column, column_type)
+                          for column, column_type in _columns(kind).items())
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS {0} (key_id INTEGER UNIQUE, key_name TEXT UNIQUE, '
+            'project TEXT, extra BLOB{1})'.format(_table(kind), columns))
+
+    def _ensure_table(self, kind):
+        if kind in TABLES or kind in self._tables:
+            return
+        with self._tables_lock:
+            self._create_table(self._connection(), kind)
+            self._tables.add(kind)
+
+    def _execute(self, statement, parameters=()):
+        return self._connection().execute(statement, parameters)
+
+    @property
+    def current_transaction(self):
+        return self._state()['transaction']
+
+    def transaction(self):
+        return Transaction(self)
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        keys = list()
+        for _ in range(num_ids):
+            id = self._execute('INSERT INTO allocated_id DEFAULT VALUES').lastrowid
+            keys.append(incomplete_key.completed_key(id))
+        return keys
+
+    def get_multi(self, keys):
+        by_kind = OrderedDict()
+        for key in keys:
+            by_kind.setdefault(key.kind, list()).append(key)
+
+        found = list()
+        for kind, kind_keys in by_kind.items():
+            self._ensure_table(kind)
+            for column in ('key_id', 'key_name'):
+                values = [key.id_or_name for key in kind_keys
+                          if (key.id is not None) == (column == 'key_id')]
+                for start in range(0, len(values), MAX_PARAMETERS):
+                    chunk = values[start:start + MAX_PARAMETERS]
+                    rows = self._execute('SELECT * FROM {0} WHERE {1} IN ({2})'.format(
+                        _table(kind), column, ', '.join('?' * len(chunk))), chunk)
+                    found.extend(_entity(kind, row) for row in rows)
+        return found
+
+    def _write(self, statements):
+        if self.current_transaction is not None:
+            for statement, parameters in statements:
+                self._execute(statement, parameters)
+            return
+
+        with self.transaction():
+            for statement, parameters in statements:
+                self._execute(statement, parameters)
+
+    def _key_condition(self, key):
+        if key.id is not None:
+            return 'key_id = ?', key.id
+        return 'key_name = ?', key.name
+
+    def put_multi(self, entities):
+        statements = list()
+        for entity in entities:
+            if entity.key.is_partial:
+                entity.key = self.allocate_ids(entity.key, 1)[0]
+
+            kind = entity.key.kind
+            self._ensure_table(kind)
+            columns = _columns(kind)
+            extra = dict((name, value) for name, value in entity.items() if name not in columns)
+            values = [entity.get(column) for column in columns] + [
+                sqlite3.Binary(pickle.dumps(extra, pickle.HIGHEST_PROTOCOL)) if extra else None]
+
+            condition, key_value = self._key_condition(entity.key)
+            statements.append(('DELETE FROM {0} WHERE {1}'.format(_table(kind), condition),
+                               [key_value]))
+            statements.append((
+                'INSERT INTO {0} (key_id, key_name, project, {1}extra) VALUES (?, ?, ?, {2}?)'.format(
+                    _table(kind),
+                    ''.join('"{0}", '.format(column) for column in columns),
+                    '?, ' * len(columns)),
+                [entity.key.id, entity.key.name, entity.key.project] + values
+            ))
+        self._write(statements)
+
+    def delete_multi(self, keys):
+        statements = list()
+        for key in keys:
+            self._ensure_table(key.kind)
+            condition, key_value = self._key_condition(key)
+            statements.append(('DELETE FROM {0} WHERE {1}'.format(_table(key.kind), condition),
+                               [key_value]))
+        self._write(statements)
+
+    def query(self, kind=None):
+        return Query(self, kind)
+
+    def _query(self, query, limit, start_cursor):
+        self._ensure_table(query.kind)
+        conditions = list()
+        parameters = list()
+        for name, op, value in query.filters:
+            if value is None and op == '=':
+                conditions.append('"{0}" IS NULL'.format(name))
+            else:
+                conditions.append('"{0}" {1} ?'.format(name, op))
+                parameters.append(value)
+
+        order = [(name.lstrip('-'), name.startswith('-')) for name in query.order]
+        for name, _ in order:
+            if name not in _columns(query.kind):
+                raise ValueError('Can\'t order {0} by {1}, it has no such column'.format(
+                    query.kind, name))
+        order.append(('rowid', False))
+
+        if start_cursor is not None:
+            condition, after = self._after(order, _decode_cursor(start_cursor))
+            conditions.append(condition)
+            parameters.extend(after)
+
+        statement = 'SELECT rowid, * FROM {0}'.format(_table(query.kind))
+        if conditions:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+        statement += ' ORDER BY ' + ', '.join(
+            '{0}{1}'.format(_column(name), ' DESC' if descending else '')
+            for name, descending in order)
+        if limit is not None:
+            statement += ' LIMIT ?'
+            parameters.append(limit + 1)
+
+        rows = self._execute(statement, parameters).fetchall()
+        next_page_token = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_page_token = _encode_cursor([rows[-1][name] for name, _ in order])
+
+        return Results(
+            [_entity(query.kind, row, keys_only=query.is_keys_only) for row in rows],
+            next_page_token
+        )
+
+    def _after(self, order, position):
+        """The condition selecting rows that sort after `position` in `order`."""
+        alternatives = list()
+        parameters = list()
+        for index, (name, descending) in enumerate(order):
+            terms = list()
+            for earlier, _ in order[:index]:
+                terms.append('{0} IS ?'.format(_column(earlier)))
+            parameters.extend(position[:index])
+
+            value = position[index]
+            if value is None:
+                # NULLs sort first, and last when descending
+                terms.append('0' if descending else '{0} IS NOT NULL'.format(_column(name)))
+            elif descending:
+                terms.append('({0} < ? OR {0} IS NULL)'.format(_column(name)))
+                parameters.append(value)
+            else:
+                terms.append('{0} > ?'.format(_column(name)))
+                parameters.append(value)
+            alternatives.append('(' + ' AND '.join(terms) + ')')
+        return '(' + ' OR '.join(alternatives) + ')', parameters
+
+    def get_members(self, course_id, kind):
+        """The users joined to a course by `kind` ('takes', 'tas' or 'teaches')."""
+        rows = self._execute(
+            'SELECT DISTINCT member.* FROM {0} AS membership '
+            'JOIN "user" AS member ON member.key_id = membership."{1}" '
+            'WHERE membership.course_id = ? ORDER BY member.key_id'.format(
+                _table(kind), MEMBER_FIELDS[kind]),
+            [course_id])
+        return [_entity('user', row) for row in rows]
+
+    def get_attendance_details(self, course_id, user_id):
+        """Every session of a course, oldest first, and whether `user_id` attended it."""
+        rows = self._execute(
+            'SELECT session.key_id AS session_id, session.opened_at AS opened_at, '
+            'session.closed_at AS closed_at, EXISTS ('
+            'SELECT 1 FROM attendance_record AS record WHERE record.user_id = ? '
+            'AND record.course_id = session.course_id '
+            'AND record.attendance_window_id = session.key_id) AS attended '
+            'FROM attendance_window AS session '
+            'WHERE session.course_id = ? '
+            'ORDER BY session.opened_at, session.closed_at, session.rowid',
+            [user_id, course_id])
+        return [{
+            'opened_at': row['opened_at'],
+            'closed_at': row['closed_at'],
+            'user_id': user_id,
+            'session_id': long(row['session_id']),
+            'attended': bool(row['attended'])
+        } for row in rows]
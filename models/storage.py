@@ -0,0 +1,93 @@
+"""The storage backends the models can run on, picked with config.DATA_BACKEND.
+
+Every backend provides a client with the subset of the google.cloud.datastore
+Client API the models use, described by StorageClient. Keys and entities are
+always google.cloud.datastore Keys and Entities, and a transaction that
+collides with another raises google.cloud.exceptions.Conflict, whichever
+backend stored them.
+"""
+
+from google.cloud import datastore
+
+
+DATASTORE = 'datastore'
+CLOUDSQL = 'cloudsql'
+MEMORY = 'memory'
+BACKENDS = (DATASTORE, CLOUDSQL, MEMORY)
+
+
+class StorageClient(object):
+    """The client interface the models program against.
+
+    google.cloud.datastore.Client already provides it; other backends
+    subclass this and implement the batched methods, the query and the
+    transaction. Queries are built with `query(kind=...)`, narrowed with
+    `add_filter(field, op, value)`, `keys_only()` and an `order` list, and
+    run with `fetch(limit=None, start_cursor=None)`, whose result is
+    iterable and has a `next_page_token` to pass as the next start_cursor.
+
+    Backends that can join kinds themselves set `supports_joins` and provide
+    `get_members(course_id, kind)` and `get_attendance_details(course_id,
+    user_id)`, which the models then use instead of joining in Python.
+    """
+
+    supports_joins = False
+
+    def __init__(self, project):
+        self.project = project
+
+    def key(self, *path):
+        return datastore.Key(*path, project=self.project)
+
+    def get(self, key):
+        entities = self.get_multi([key])
+        return entities[0] if entities else None
+
+    def get_multi(self, keys):
+        """Return the entities that exist for `keys`, in no particular order."""
+        raise NotImplementedError
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        """Save `entities`, completing the keys of any that don't have an id yet."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        raise NotImplementedError
+
+    def allocate_ids(self, incomplete_key, num_ids):
+        raise NotImplementedError
+
+    def query(self, kind=None):
+        raise NotImplementedError
+
+    def transaction(self):
+        """A context manager committing the writes made inside it all at once."""
+        raise NotImplementedError
+
+    @property
+    def current_transaction(self):
+        raise NotImplementedError
+
+
+def supports_joins(client):
+    return getattr(client, 'supports_joins', False)
+
+
+def create_client(project, backend):
+    """Build a client for `project` on the named backend."""
+    if backend == DATASTORE:
+        return datastore.Client(project)
+    if backend == CLOUDSQL:
+        import config
+        from models import sql_backend
+        return sql_backend.Client(project, config.SQL_DATABASE)
+    if backend == MEMORY:
+        from models import memory_backend
+        return memory_backend.Client(project)
+    raise ValueError('Unsupported data backend ' + repr(backend))
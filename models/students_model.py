@@ -10,14 +10,15 @@ class Student(users_model.User):
         if uni is None or len(uni) == 0:
             raise ValueError('Students must have UNIs')
 
-        query = self.datastore.query(kind='user')
-        query.add_filter('uni', '=', uni)
-        conflicting_students = list(query.fetch())
-        if len(conflicting_students) > 0:
+        # claiming the UNI's index entity in a transaction rules out two
+        # students registering with the same UNI at once
+        try:
+            self.update(uni=uni)
+        except users_model.DuplicateUserException as e:
+            if e.field != 'uni':
+                raise
             raise DuplicateUNIException('Student with UNI ' + uni + ' already exists.')
 
-        self.update(uni=uni)
-
         return self
 
     def sign_in(self, course, secret=None):
@@ -35,18 +36,20 @@ class Student(users_model.User):
 
         return course.has_student(self)
 
-    def get_courses(self):
+    def get_course_ids(self):
         if not self.fetched or not self.is_student():
             raise ValueError('User must be saved to have a course')
 
         query = self.datastore.query(kind='takes')
         query.add_filter('student_id', '=', self.get_id())
-        takes = list(query.fetch())
-        return [courses_model.Course(id=take['course_id']) for take in takes]
+        return [take['course_id'] for take in query.fetch()]
+
+    def get_courses(self):
+        return courses_model.Course.get_multi(self.get_course_ids())
 
     def as_TA(self):
         from models import tas_model
-        if not self.fetched:
+        if self.loaded and not self.fetched:
             return tas_model.TA(**self.model)
 
         return tas_model.TA(id=self.get_id())
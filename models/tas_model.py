@@ -8,14 +8,16 @@ class TA(students_model.Student):
 
         return course.has_TA(self)
 
-    def get_taed_courses(self):
+    def get_taed_course_ids(self):
         if not self.fetched:
             raise ValueError('TA must be saved to TA a course')
 
         query = self.datastore.query(kind='tas')
         query.add_filter('ta_id', '=', self.get_id())
-        tas = list(query.fetch())
-        return [courses_model.Course(id=ta['course_id']) for ta in tas]
+        return [ta['course_id'] for ta in query.fetch()]
+
+    def get_taed_courses(self):
+        return courses_model.Course.get_multi(self.get_taed_course_ids())
 
     def as_TA(self):
         return self
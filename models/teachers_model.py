@@ -1,4 +1,6 @@
+import config
 from models import courses_model, users_model
+from models.model import get_join
 
 
 class Teacher(users_model.User):
@@ -17,14 +19,14 @@ class Teacher(users_model.User):
             raise ValueError('Course must have a name')
 
         course = courses_model.Course(name=name).get_or_create()
-        self.create_entity(
-            kind='teaches',
-            teacher_id=self.get_id(),
-            course_id=course.get_id()
+        course._change_membership(
+            'teacher_ids',
+            lambda: course.create_join(
+                'teaches', teacher_id=self.get_id(), course_id=course.get_id()),
+            add=[self.get_id()]
         )
 
-        while not self.teaches_course(course):
-            pass
+        self.confirm_write('add_course', lambda: self.teaches_course(course))
 
         return course
 
@@ -47,17 +49,19 @@ class Teacher(users_model.User):
         if not self.fetched or not course.fetched:
             return False
 
-        query = self.datastore.query(kind='teaches')
-        query.add_filter('teacher_id', '=', self.get_id())
-        query.add_filter('course_id', '=', course.get_id())
-        query.keys_only()
-        return len(list(query.fetch())) > 0
+        if config.MEMBERSHIP_SUMMARY:
+            return self.get_id() in course.get_membership_summary().get('teacher_ids', [])
 
-    def get_courses(self):
+        return get_join(
+            self.datastore, 'teaches', course_id=course.get_id(), teacher_id=self.get_id()) is not None
+
+    def get_course_ids(self):
         if not self.fetched or not self.is_teacher():
             return list()
 
         query = self.datastore.query(kind='teaches')
         query.add_filter('teacher_id', '=', self.get_id())
-        joins = query.fetch()
-        return [courses_model.Course(id=join['course_id']) for join in joins]
+        return [join['course_id'] for join in query.fetch()]
+
+    def get_courses(self):
+        return courses_model.Course.get_multi(self.get_course_ids())
@@ -1,57 +1,249 @@
-from model import Model
+from model import Model, MAX_MUTATION_BATCH, get_multi
+from caches import LockedCache
+from collections import OrderedDict
+from google.cloud import datastore
+import cachetools
+import config
+import fanout
+
+
+# properties no two users share, each with a kind of index entity named after
+# the value and holding the id of the user who has it, so finding a user by
+# one is a strongly consistent key lookup instead of a query
+INDEX_KINDS = OrderedDict([
+    ('uni', 'user_by_uni'),
+    ('email', 'user_by_email')
+])
+INDEXED_FIELDS = dict((kind, field) for field, kind in INDEX_KINDS.items())
+
+# (property, value) -> id of the user who has it; only users that were found
+_user_ids = LockedCache(cachetools.TTLCache(
+    maxsize=config.USER_INDEX_CACHE_SIZE,
+    ttl=config.USER_INDEX_CACHE_TTL
+))
+
+
+class DuplicateUserException(Exception):
+    """Another user already has a value of one of the INDEX_KINDS properties."""
+
+    def __init__(self, field, value, user_id):
+        super(DuplicateUserException, self).__init__(
+            'Another user already has {0} {1}'.format(field, value))
+        self.field = field
+        self.value = value
+        self.user_id = user_id
+
+
+def index_key(client, field, value):
+    """The key of the index entity for users whose `field` is `value`."""
+    return client.key(INDEX_KINDS[field], value)
+
+
+def index_entities(client, user, fields=INDEX_KINDS):
+    """The index entities pointing at the `user` entity, one per indexed value it has."""
+    entities = list()
+    for field in fields:
+        if user.get(field):
+            entity = datastore.Entity(key=index_key(client, field, user[field]))
+            entity['user_id'] = user.key.id
+            entities.append(entity)
+    return entities
+
+
+def save_indexes(client, users, fields=INDEX_KINDS):
+    """Point the index entities of `fields` at the given user entities, in batched puts.
+
+    For users written without going through User, e.g. by bulk seeding or
+    before the indexes existed. Doesn't check for duplicates.
+    """
+    entities = [entity for user in users for entity in index_entities(client, user, fields)]
+    for start in range(0, len(entities), MAX_MUTATION_BATCH):
+        client.put_multi(entities[start:start + MAX_MUTATION_BATCH])
+
+
+def find_ids(client, field, values):
+    """Map each of `values` that belongs to a registered user to that user's id.
+
+    Cached values cost nothing; the rest are one batched lookup of their index
+    entities, however many there are, and then find_unindexed_ids for any
+    the index doesn't know.
+    """
+    ids = dict()
+    missing = list()
+    for value in set(values):
+        id = _user_ids.get((field, value))
+        if id is None:
+            missing.append(value)
+        else:
+            ids[value] = id
+
+    for entity in get_multi(client, [index_key(client, field, value) for value in missing]):
+        ids[entity.key.name] = entity['user_id']
+        _user_ids.set((field, entity.key.name), entity['user_id'])
+
+    unindexed = [value for value in missing if value not in ids]
+    for value, id in find_unindexed_ids(client, field, unindexed).items():
+        ids[value] = id
+        _user_ids.set((field, value), id)
+    return ids
+
+
+def find_unindexed_ids(client, field, values):
+    """Map each of `values` held by a user saved before the indexes existed to that user's id.
+
+    Each value is a query, all made at the same time, and the users found are
+    indexed so the next lookup is a key lookup. Answers {} without a query
+    once LEGACY_USERS is off, i.e. after `python -m models.migrations
+    user-indexes` has indexed them all.
+    """
+    if not config.LEGACY_USERS or not values:
+        return dict()
+
+    def holder(value):
+        query = client.query(kind='user')
+        query.add_filter(field, '=', value)
+        users = list(query.fetch())
+        return min(users, key=lambda user: user.key.id) if users else None
+
+    users = [user for user in fanout.gather(*[
+        (lambda value=value: holder(value)) for value in values]) if user is not None]
+    save_indexes(client, users, fields=[field])
+    return dict((user[field], user.key.id) for user in users)
+
+
+def find_ids_by_uni(client, unis):
+    """Map each of `unis` that belongs to a registered user to that user's id."""
+    return find_ids(client, 'uni', unis)
 
 
 class User(Model):
+    kind = 'user'
+
     def __init__(self, **kwargs):
         self.datastore = self.get_client()
 
         self.fetched = False
 
+        # fetch by id on first use, unless there's a uni or email to fall back to
+        if 'id' in kwargs and not any(kwargs.get(field) for field in INDEX_KINDS):
+            self.defer_load(self.datastore.key('user', kwargs['id']), kwargs)
+            return
+
         # try to fetch by id
         if 'id' in kwargs:
             key = self.datastore.key('user', kwargs['id'])
-            self.model = self.datastore.get(key)
+            self.model = self.load_entity(key)
             self.fetched = bool(self.model)
 
-        # try to fetch by uni
-        if not self.fetched and 'uni' in kwargs:
-            model_query = self.datastore.query(kind='user')
-            model_query.add_filter('uni', '=', kwargs['uni'])
-            users = list(model_query.fetch())
-            if len(users) > 0:
-                self.model = users[0]
-                self.fetched = True
-
-        # try to fetch by email
-        if not self.fetched and 'email' in kwargs:
-            model_query = self.datastore.query(kind='user')
-            model_query.add_filter('email', '=', kwargs['email'])
-            users = list(model_query.fetch())
-            if len(users) == 0:
-                self.fetched = False
-                self.model = kwargs
-            else:
-                self.fetched = True
-                self.model = users[0]
+        # try to fetch by uni, then by email
+        for field in INDEX_KINDS:
+            if not self.fetched and kwargs.get(field):
+                self.fetched = self._load_by(field, kwargs[field])
 
         # no other unique fields
         if not self.fetched:
             self.fetched = False
             self.model = kwargs
 
+    def _load_by(self, field, value):
+        # a second try goes past a cached id that's gone stale
+        for attempt in range(2):
+            id = find_ids(self.datastore, field, [value]).get(value)
+            if id is None:
+                return False
+
+            entity = self.load_entity(self.datastore.key('user', id))
+            if entity is not None and entity.get(field) == value:
+                self.model = entity
+                return True
+            _user_ids.discard((field, value))
+        return False
+
     def is_teacher(self):
         return self.get('teacher', False)
 
     def is_student(self):
         return self.get('uni') is not None
 
+    def _save(self, user, previous=None):
+        """Put the `user` entity and point its index entities at it, in one transaction.
+
+        Index entities of values `previous` had and `user` doesn't are deleted.
+        Raises DuplicateUserException if another user holds one of its values.
+        """
+        client = self.datastore
+        claims = index_entities(client, user)
+        released = [
+            index_key(client, field, previous[field]) for field in INDEX_KINDS
+            if previous is not None and previous.get(field) and
+            previous.get(field) != user.get(field)
+        ]
+
+        # a user saved before the indexes only holds its values once they're indexed
+        if config.LEGACY_USERS:
+            for entity in claims:
+                field = INDEXED_FIELDS[entity.key.kind]
+                if previous is None or previous.get(field) != user[field]:
+                    find_ids(client, field, [user[field]])
+
+        def save():
+            held = get_multi(client, [entity.key for entity in claims] + released)
+            others = dict((entity.key.flat_path, entity['user_id']) for entity in held
+                          if entity['user_id'] != user.key.id)
+            if others:
+                # an index entity whose user is gone doesn't count
+                owners = set(entity.key.id for entity in get_multi(
+                    client, [client.key('user', id) for id in set(others.values())]))
+                for entity in claims:
+                    owner = others.get(entity.key.flat_path)
+                    if owner in owners:
+                        raise DuplicateUserException(
+                            INDEXED_FIELDS[entity.key.kind], entity.key.name, owner)
+
+            client.put_multi([user] + claims)
+            ours = [key for key in released if key.flat_path not in others]
+            if ours:
+                client.delete_multi(ours)
+
+        self.run_in_transaction(save)
+        self.forget_entity(user.key)
+
+        for field in INDEX_KINDS:
+            if previous is not None and previous.get(field):
+                _user_ids.discard((field, previous[field]))
+            if user.get(field):
+                _user_ids.set((field, user[field]), user.key.id)
+
+    def update(self, **kwargs):
+        if not any(field in kwargs for field in INDEX_KINDS):
+            return super(User, self).update(**kwargs)
+
+        user = self.build_entity(self.get_key(), **self.model)
+        user.update(kwargs)
+        self._save(user, previous=self.model)
+        self.model = user
+
+    def destroy(self):
+        if self.fetched:
+            keys = [entity.key for entity in index_entities(self.datastore, self.model)]
+            self.datastore.delete_multi([
+                entity.key for entity in get_multi(self.datastore, keys)
+                if entity['user_id'] == self.get_id()
+            ])
+            for field in INDEX_KINDS:
+                _user_ids.discard((field, self.get(field)))
+
+        super(User, self).destroy()
+
     def get_or_create(self):
         if not self.fetched:
-            key = self.create_entity(
-                kind='user',
-                **self.model
-            )
-            self.model = self.datastore.get(key)
+            key = self.datastore.allocate_ids(self.datastore.key('user'), 1)[0]
+            try:
+                self._save(self.build_entity(key, **self.model))
+            except DuplicateUserException as e:
+                # someone else created this user first
+                key = self.datastore.key('user', e.user_id)
+            self.model = self.load_entity(key)
             self.fetched = True
 
         return self
@@ -1,6 +1,20 @@
-from models import teachers_model, students_model, courses_model, tas_model
-
+from models import teachers_model, students_model, courses_model, tas_model, client_pool
+from models import consistency, fanout, instrumentation, memory_backend, sql_backend, users_model
+from models import cascade, migrations, model
+from models.caches import LockedCache
+from imhere import exports, jobs, principal, view_models
+from google.cloud import datastore
+from google.cloud.exceptions import Conflict
+
+from datetime import datetime
+
+import cachetools
+import config
+import flask
+import json
 import pytest
+import threading
+import time
 
 teacher_user_data = {
     'family_name': 'Teacher',
@@ -493,6 +507,94 @@ def test_student_registration():
     ta.register_as_student(uni='two')
 
 
+def test_legacy_joins_in_bulk_adds_and_edits():
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        ta = context['ta']
+        client = course.datastore
+
+        # a TA enrolled before joins had keys
+        legacy = datastore.Entity(key=client.key('takes'))
+        legacy.update(course_id=course.get_id(), student_id=ta.get_id())
+        client.put(legacy)
+        assert course.add_students_by_uni(['student2']) == {
+            'student2': courses_model.ALREADY_ENROLLED}, 'Legacy member was added again'
+        query = client.query(kind='takes')
+        query.add_filter('course_id', '=', course.get_id())
+        assert len(list(query.fetch())) == 1, 'Legacy member got a second join'
+
+        course.add_student(student)
+        add_attendance_records(course, [], 1)
+        session_id = course.get_sessions()[0].key.id
+        record = datastore.Entity(key=client.key('attendance_record'))
+        record.update(course_id=course.get_id(), attendance_window_id=session_id,
+                      user_id=student.get_id())
+        client.put(record)
+        course.rebuild_counters()
+
+        course.edit_attendance_history(student=student, session_id=session_id, attended=True)
+        assert len(course.get_attendance_records(student=student)) == 1, (
+            'Legacy record was recorded again')
+        course.edit_attendance_history(student=student, session_id=session_id, attended=False)
+        assert not course.get_attendance_records(student=student), 'Legacy record was kept'
+        assert course.attendance_count(student) == 0, (
+            'Attendance counter is {}'.format(course.attendance_count(student)))
+
+
+def test_add_course_joins_teacher(monkeypatch):
+    with common_context() as context:
+        teacher = context['teacher']
+        with flask.Flask(__name__).app_context():
+            stats = instrumentation.start()
+            course = teacher.add_course('Course 2')
+        try:
+            assert stats.counts[instrumentation.QUERY] == 0, (
+                'Creating a course made {} queries'.format(stats.counts[instrumentation.QUERY]))
+            client = course.datastore
+            join = client.get(model.join_key(
+                client, 'teaches', course_id=course.get_id(), teacher_id=teacher.get_id()))
+            assert join is not None, 'Course has no teaches join'
+            assert join['teacher_id'] == teacher.get_id(), 'Join is for {}'.format(join['teacher_id'])
+            assert course.get_membership_summary()['teacher_ids'] == [teacher.get_id()], (
+                'Summary teachers are {}'.format(course.get_membership_summary()['teacher_ids']))
+            assert teacher.teaches_course(course), 'Teacher does not teach course'
+
+            monkeypatch.setattr(config, 'MEMBERSHIP_SUMMARY', False)
+            assert teacher.teaches_course(course), 'Teacher not found by join key'
+            assert course.get_id() in teacher.get_course_ids(), 'Course missing from teacher'
+        finally:
+            course.destroy()
+
+        # the join is written in the summary's transaction, so it's rolled back with it
+        monkeypatch.setattr(config, 'MEMBERSHIP_SUMMARY', True)
+        other = next(client for client in client_pool.get_pool().warm_up()._clients
+                     if client is not teacher.datastore)
+        monkeypatch.setattr(courses_model.Course, 'get_client', lambda self: other)
+
+        # the first summary is built before the transaction; fail the one written in it
+        build = courses_model.Course._membership_entity
+        calls = list()
+
+        def fail(self, **lists):
+            calls.append(lists)
+            if len(calls) > 1:
+                raise RuntimeError('summary write failed')
+            return build(self, **lists)
+        monkeypatch.setattr(courses_model.Course, '_membership_entity', fail)
+        with pytest.raises(RuntimeError):
+            teacher.add_course('Course 3')
+        monkeypatch.undo()
+
+        query = other.query(kind='course')
+        query.add_filter('name', '=', 'Course 3')
+        for entity in query.fetch():
+            assert other.get(model.join_key(
+                other, 'teaches', course_id=entity.key.id, teacher_id=teacher.get_id())) is None, (
+                'Join outlived its transaction')
+            courses_model.Course(id=entity.key.id).destroy()
+
+
 def test_course_creation_deletion():
     with common_context() as context:
         course = context['course']
@@ -531,3 +633,862 @@ def test_course_creation_deletion():
         assert not ta.tas_course(course), 'TA still TA\'s course.'
 
         assert not teacher.teaches_course(course), 'Teacher still teaches course.'
+
+
+def seed_cascade(project, kinds, per_kind):
+    client = memory_backend.Client(project)
+    for kind in kinds:
+        entities = list()
+        for _ in range(per_kind):
+            entity = datastore.Entity(key=client.key(kind))
+            entity['course_id'] = 7
+            entities.append(entity)
+        client.put_multi(entities)
+    return client
+
+
+def remaining(client, kinds):
+    counts = dict()
+    for kind in kinds:
+        query = client.query(kind=kind)
+        query.add_filter('course_id', '=', 7)
+        counts[kind] = len(list(query.fetch()))
+    return counts
+
+
+def test_cascade_deleter_pages_through_every_kind():
+    kinds = ['takes', 'tas']
+    client = seed_cascade('cascade-paging', kinds, 5)
+    progress = list()
+    deleter = cascade.CascadeDeleter(client, kinds, 'course_id', 7, page_size=2,
+                                     on_progress=lambda count, at: progress.append(count))
+    assert deleter.run() == 10, 'Deleted {}'.format(deleter.deleted)
+    assert progress == [2, 2, 1, 2, 2, 1], 'Deleted in batches of {}'.format(progress)
+    assert remaining(client, kinds) == {'takes': 0, 'tas': 0}, 'Entities were left behind'
+    assert deleter.checkpoint == (2, None), 'Finished at {}'.format(deleter.checkpoint)
+
+
+def test_cascade_deleter_checkpoints_in_order_when_batches_finish_out_of_order():
+    kinds = ['takes']
+    client = seed_cascade('cascade-parallel', kinds, 8)
+    delete_multi = client.delete_multi
+    calls = list()
+
+    def slow_first(keys):
+        calls.append(len(keys))
+        if len(calls) == 1:
+            time.sleep(0.05)
+        delete_multi(keys)
+
+    client.delete_multi = slow_first
+    checkpoints = list()
+    deleter = cascade.CascadeDeleter(client, kinds, 'course_id', 7, page_size=2, workers=3,
+                                     on_progress=lambda count, at: checkpoints.append(at))
+    assert deleter.run() == 8, 'Deleted {}'.format(deleter.deleted)
+    assert [index for index, _ in checkpoints] == [0, 0, 0, 1], (
+        'Checkpoints were {}'.format(checkpoints))
+    assert len(set(cursor for _, cursor in checkpoints[:3])) == 3, 'Checkpoint went backwards'
+    assert remaining(client, kinds) == {'takes': 0}, 'Entities were left behind'
+
+
+def test_cascade_deleter_resumes_from_checkpoint():
+    kinds = ['takes', 'tas']
+    client = seed_cascade('cascade-resume', kinds, 3)
+    delete_multi = client.delete_multi
+    checkpoints = list()
+
+    def fail_third(keys):
+        if len(checkpoints) == 2:
+            raise RuntimeError('Interrupted')
+        delete_multi(keys)
+
+    client.delete_multi = fail_third
+    deleter = cascade.CascadeDeleter(client, kinds, 'course_id', 7, page_size=2,
+                                     on_progress=lambda count, at: checkpoints.append(at))
+    with pytest.raises(RuntimeError):
+        deleter.run()
+    assert remaining(client, kinds) == {'takes': 0, 'tas': 3}, 'Deleted {}'.format(
+        remaining(client, kinds))
+
+    client.delete_multi = delete_multi
+    queried = list()
+    query = client.query
+    client.query = lambda kind=None: (queried.append(kind), query(kind))[1]
+    resumed = cascade.CascadeDeleter(client, kinds, 'course_id', 7, page_size=2,
+                                     checkpoint=checkpoints[-1])
+    assert resumed.run() == 3, 'Resumed run deleted {}'.format(resumed.deleted)
+    assert 'takes' not in queried, 'Resumed run went back over finished kinds'
+    assert remaining(client, kinds) == {'takes': 0, 'tas': 0}, 'Entities were left behind'
+
+
+def test_models_share_pooled_clients():
+    pool = client_pool.get_pool()
+    clients = set(id(courses_model.Course(name='Pooled').datastore)
+                  for _ in range(pool.size * 3))
+    assert len(clients) <= pool.size, (
+        'Models built {} clients with a pool of size {}'.format(len(clients), pool.size))
+
+
+def test_write_confirmation_backs_off_until_deadline():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    confirmer = consistency.WriteConfirmer(
+        strategy=consistency.BACKOFF, deadline=1.0, initial_delay=0.1, max_delay=0.4,
+        sleep=sleep, clock=lambda: now[0])
+
+    answers = iter([False, False, True])
+    assert confirmer.confirm('write', lambda: next(answers)) == 3, (
+        'Backoff confirmation did not stop at the first successful poll')
+    assert sleeps == [0.1, 0.2], 'Backoff delays were {}'.format(sleeps)
+
+    started = now[0]
+    with pytest.raises(consistency.WriteConfirmationTimeout):
+        confirmer.confirm('write', lambda: False)
+    assert now[0] - started <= 1.0 + 1e-9, 'Backoff overshot its deadline'
+
+    stats = confirmer.stats()['write']
+    assert (stats['writes'], stats['polls'], stats['timeouts']) == (1, 3, 1), (
+        'Write confirmation stats were {}'.format(stats))
+
+    lookups = consistency.WriteConfirmer(strategy=consistency.LOOKUP)
+    assert lookups.confirm('write', lambda: False, lambda: True) == 1, (
+        'Lookup strategy polled the eventually consistent check')
+    assert consistency.WriteConfirmer(strategy=consistency.NONE).confirm(
+        'write', lambda: False) == 0, 'None strategy polled'
+
+
+def test_identity_map_fetches_each_entity_once_per_request():
+    with common_context() as context:
+        course_id = context['course'].get_id()
+        with flask.Flask(__name__).app_context():
+            course = courses_model.Course(id=course_id)
+            assert courses_model.Course(id=course_id).model is course.model, (
+                'Same course fetched twice within one request')
+
+            course.update(name='Renamed Course')
+            renamed = courses_model.Course(id=course_id)
+            assert renamed.model is not course.model, 'Update did not invalidate identity map'
+            assert renamed.get('name') == 'Renamed Course', 'Refetched course is stale'
+
+        assert courses_model.Course(id=course_id).model is not course.model, (
+            'Identity map outlived its request')
+
+
+def test_batched_lookups_keep_order_and_report_missing(monkeypatch):
+    with common_context() as context:
+        course = context['course']
+        client = course.datastore
+        monkeypatch.setattr(model, 'MAX_LOOKUP_BATCH', 2)
+        batches = list()
+        get_multi = client.get_multi
+        monkeypatch.setattr(client, 'get_multi', lambda keys: (
+            batches.append(len(keys)), get_multi(keys))[1])
+
+        ids = [context[name].get_id() for name in ('teacher', 'student', 'ta')]
+        keys = [client.key('user', id) for id in ids] + [client.key('user', -1)]
+        entities = model.load_entities(client, list(reversed(keys)))
+        assert entities[0] is None, 'Missing key came back as {}'.format(entities[0])
+        assert [entity.key.id for entity in entities[1:]] == list(reversed(ids)), (
+            'Lookups came back out of order')
+        assert batches == [2, 2], 'Looked up in batches of {}'.format(batches)
+
+        users = users_model.User.get_multi(ids + [-1])
+        assert [user.get_id() for user in users] == ids, 'get_multi returned {}'.format(
+            [user.get_id() for user in users])
+        assert all(user.fetched for user in users), 'from_entity model is not fetched'
+
+
+def test_roster_pages_return_each_member_once():
+    with common_context() as context:
+        course = context['course']
+        extra = [students_model.Student(name='Paged ' + uni, email=uni + '@example.com')
+                 .get_or_create().register_as_student(uni=uni) for uni in ('paged1', 'paged2')]
+        try:
+            students = [context['student'], context['ta']] + extra
+            for student in students:
+                course.add_student(student)
+            course.add_TA(context['ta'])
+
+            for limit in (1, 2, 3, 5):
+                seen = list()
+                page, cursor = course.get_students_page(limit)
+                seen.extend(page)
+                while cursor is not None:
+                    assert len(page) == limit, 'Short page {} before the last'.format(len(page))
+                    page, cursor = course.get_students_page(limit, cursor)
+                    seen.extend(page)
+                assert sorted(student.get_id() for student in seen) == sorted(
+                    student.get_id() for student in students), (
+                    'Paging by {} returned {}'.format(limit, [s.get_id() for s in seen]))
+
+            tas, cursor = course.get_TAs_page(5)
+            assert [ta.get_id() for ta in tas] == [context['ta'].get_id()] and cursor is None, (
+                'TA page is {}'.format(tas))
+        finally:
+            for student in extra:
+                student.destroy()
+
+
+def test_locked_cache():
+    clock = [0.0]
+    cache = LockedCache(cachetools.TTLCache(maxsize=2, ttl=5, timer=lambda: clock[0]))
+    missing = object()
+    assert cache.get('a', missing) is missing, 'Empty cache had a value'
+    cache.set('a', None)
+    assert cache.get('a', missing) is None, 'Cached None was not kept'
+    cache.discard('a')
+    cache.discard('a')
+    assert cache.get('a', missing) is missing, 'Discarded value was kept'
+
+    cache.set('b', 1)
+    clock[0] = 6
+    assert cache.get('b') is None, 'Value outlived its TTL'
+    cache.set('c', 2)
+    cache.clear()
+    assert cache.get('c') is None, 'Cleared cache kept a value'
+
+
+def test_open_session_cache(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(courses_model, '_open_sessions', LockedCache(
+        cachetools.TTLCache(maxsize=10, ttl=5, timer=lambda: clock[0])))
+    queries = list()
+    query_open_session = courses_model.Course._query_open_session
+    monkeypatch.setattr(courses_model.Course, '_query_open_session', lambda self: (
+        queries.append(self.get_id()), query_open_session(self))[1])
+
+    def queries_made(call):
+        before = len(queries)
+        result = call()
+        return result, len(queries) - before
+
+    with common_context() as context:
+        course = context['course']
+        assert queries_made(course.get_open_session) == (None, 1), 'First lookup not queried'
+        assert queries_made(course.get_open_session) == (None, 0), 'Cached lookup queried'
+
+        secret = course.open_session()
+        session, made = queries_made(course.get_open_session)
+        assert made == 0 and session['secret'] == secret, 'Opening did not update the cache'
+
+        course.close_session()
+        assert queries_made(course.get_open_session) == (None, 1), (
+            'Closing did not invalidate the cache')
+
+        secret = course.open_session()
+        clock[0] = 6
+        session, made = queries_made(course.get_open_session)
+        assert made == 1 and session['secret'] == secret, 'Expired entry was not queried again'
+        course.close_session()
+
+
+def test_open_sessions_of_many_courses(monkeypatch):
+    monkeypatch.setattr(courses_model, '_open_sessions', LockedCache(
+        cachetools.TTLCache(maxsize=10, ttl=5)))
+    with common_context() as context:
+        course = context['course']
+        other = context['teacher'].add_course('Course 2')
+        try:
+            client = course.datastore
+            course.open_session()
+            # a second window opened at the same time as the first
+            later = datastore.Entity(key=client.key('attendance_window'))
+            later.update(course_id=course.get_id(), opened_at=datetime.now(), closed_at=None,
+                         secret=1234)
+            client.put(later)
+            courses_model._open_sessions.clear()
+
+            sessions = courses_model.get_open_sessions(client, [course.get_id(), other.get_id()])
+            assert sessions[course.get_id()].key == later.key, (
+                'Open window is {}'.format(sessions[course.get_id()].key))
+            assert sessions[other.get_id()] is None, 'Course without a window has one'
+
+            courses_model._open_sessions.clear()
+            assert course.get_open_session().key == later.key, 'Courses disagree on the window'
+        finally:
+            other.destroy()
+
+
+def test_close_session_closes_every_open_window():
+    with common_context() as context:
+        course = context['course']
+        client = course.datastore
+        course.open_session()
+        # a second window opened at the same time as the first
+        other = datastore.Entity(key=client.key('attendance_window'))
+        other.update(course_id=course.get_id(), opened_at=datetime.now(), closed_at=None,
+                     secret=1234)
+        client.put(other)
+
+        course.close_session()
+        assert course.get_open_session() is None, 'A window was left open'
+        assert courses_model.query_open_windows(client, course.get_id()) == [], (
+            'Windows still open after closing')
+
+
+def test_bulk_enrollment_reports_per_uni():
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        ta = context['ta']
+        course.add_student(student)
+
+        report = course.add_students_by_uni(['student1', 'student2', 'nobody', 'student2'])
+        assert report == {
+            'student1': courses_model.ALREADY_ENROLLED,
+            'student2': courses_model.ADDED,
+            'nobody': courses_model.UNKNOWN
+        }, 'Bulk enrollment reported {}'.format(report)
+        assert course.has_student(ta), 'Bulk enrolled student not in course'
+        assert len(course.get_students()) == 2, 'Bulk enrollment duplicated join rows'
+
+        report = course.add_TAs_by_uni(['student2'])
+        assert report == {'student2': courses_model.ADDED}, (
+            'Bulk TA hiring reported {}'.format(report))
+        assert course.has_TA(ta), 'Bulk hired TA not in course'
+
+
+def test_local_job_queue_runs_inline_and_reports_progress():
+    runner = jobs.JobRunner(jobs.LocalQueue(), history=2)
+
+    def work(job):
+        job.advance({'one': courses_model.ADDED})
+        job.advance({'two': courses_model.UNKNOWN})
+
+    job = runner.enqueue('import', work, owner_id=1, total=2)
+    status = job.to_dict()
+    assert (status['status'], status['done'], status['total']) == (jobs.DONE, 2, 2), (
+        'Local job finished with status {}'.format(status))
+    assert status['results'] == {'one': courses_model.ADDED, 'two': courses_model.UNKNOWN}, (
+        'Local job reported results {}'.format(status['results']))
+
+    failed = runner.enqueue('explode', lambda job: 1 / 0)
+    assert failed.status == jobs.FAILED and failed.error, 'Failing job not marked failed'
+
+    runner.enqueue('noop', lambda job: None)
+    assert runner.get(job.id) is None, 'Job runner kept more jobs than its history'
+    assert runner.get(failed.id) is failed, 'Job runner lost a recent job'
+
+
+def test_inline_jobs_finish_before_enqueue_returns():
+    runner = jobs.JobRunner(jobs.ThreadPoolQueue(1))
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(job):
+        started.set()
+        release.wait(5)
+
+    background = runner.enqueue('block', block)
+    started.wait(5)
+    job = runner.enqueue('import', lambda job: job.advance({'one': courses_model.ADDED}),
+                         inline=True)
+    assert job.status == jobs.DONE and job.results == {'one': courses_model.ADDED}, (
+        'Inline job is {}'.format(job.to_dict()))
+    assert runner.get(job.id) is job, 'Inline job has no status'
+    assert background.status == jobs.RUNNING, 'Background job is {}'.format(background.status)
+    release.set()
+
+
+def test_attendance_matrix():
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        ta = context['ta']
+        course.add_student(student)
+        course.add_TA(ta)
+        course.add_TA(student)
+        add_attendance_records(course, [student], 1)
+        add_attendance_records(course, [ta], 2)
+
+        matrix = course.get_attendance_matrix()
+        assert len(matrix['sessions']) == 3, (
+            'Matrix has {} sessions instead of 3'.format(len(matrix['sessions'])))
+        rows = dict((member['user_id'], member) for member in matrix['members'])
+        assert len(rows) == 2, 'Matrix has {} members instead of 2'.format(len(rows))
+        assert rows[student.get_id()]['attended'] == [True, False, False], (
+            'Student matrix row is {}'.format(rows[student.get_id()]['attended']))
+        assert rows[student.get_id()]['roles'] == ['student', 'TA'], (
+            'Student-TA roles are {}'.format(rows[student.get_id()]['roles']))
+        assert rows[ta.get_id()]['attended'] == [False, True, True], (
+            'TA matrix row is {}'.format(rows[ta.get_id()]['attended']))
+        assert rows[ta.get_id()]['total'] == 2, 'TA total is {}'.format(rows[ta.get_id()]['total'])
+
+
+def test_membership_summary():
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        ta = context['ta']
+        teacher = context['teacher']
+        course.add_student(student)
+        course.add_TA(ta)
+
+        summary = course.get_membership_summary()
+        assert summary['teacher_ids'] == [teacher.get_id()], (
+            'Summary teachers are {}'.format(summary['teacher_ids']))
+        assert summary['student_ids'] == [student.get_id()], (
+            'Summary students are {}'.format(summary['student_ids']))
+        assert summary['ta_count'] == 1, 'Summary has {} TAs'.format(summary['ta_count'])
+
+        course.remove_student(student)
+        summary = course.get_membership_summary()
+        assert summary['student_count'] == 0, (
+            'Summary still has {} students'.format(summary['student_count']))
+        assert not course.has_student(student), 'Removed student still in course'
+
+        # joins written directly, e.g. by a seeding script, need a rebuild
+        course.create_entities('takes', [{'course_id': course.get_id(),
+                                          'student_id': student.get_id()}])
+        assert course.rebuild_membership_summary()['student_ids'] == [student.get_id()], (
+            'Rebuilt summary missed a student')
+        assert course.has_student(student), 'Rebuilt summary not used'
+
+
+def test_join_keys(monkeypatch):
+    monkeypatch.setattr(config, 'MEMBERSHIP_SUMMARY', False)
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        ta = context['ta']
+        client = course.datastore
+
+        key = model.join_key(client, 'takes', student_id=student.get_id(), course_id=course.get_id())
+        assert key == model.join_key(
+            client, 'takes', course_id=course.get_id(), student_id=student.get_id()), (
+            'Join key depends on argument order')
+        assert key.name == '{}:{}'.format(course.get_id(), student.get_id()), (
+            'Join key is {}'.format(key.name))
+
+        course.add_student(student)
+        course.add_student(student)
+        query = client.query(kind='takes')
+        query.add_filter('course_id', '=', course.get_id())
+        takes = list(query.fetch())
+        assert [join.key for join in takes] == [key], 'Student joined {} times'.format(len(takes))
+
+        # joins saved under allocated ids before joins had keys
+        for kind, ids in [('takes', {'student_id': ta.get_id()}), ('tas', {'ta_id': ta.get_id()})]:
+            legacy = datastore.Entity(key=client.key(kind))
+            legacy.update(course_id=course.get_id(), **ids)
+            client.put(legacy)
+        assert course.has_student(ta) and course.has_TA(ta), 'Legacy joins were not seen'
+        assert course.get_memberships([ta])[ta.get_id()] == (True, True), (
+            'Legacy joins were not seen in a batched check')
+        course.remove_student(ta)
+        assert not course.has_student(ta), 'Legacy join survived removal'
+
+        monkeypatch.setattr(config, 'LEGACY_JOINS', False)
+        assert not course.has_TA(ta), 'Legacy joins looked up after migration'
+
+        counted = migrations.migrate_join_keys(client, dry_run=True)
+        assert counted['tas'] >= 1, 'Dry run found no legacy TA joins'
+        assert not course.has_TA(ta), 'Dry run moved joins'
+        assert migrations.migrate_join_keys(client) == counted, 'Migration moved other joins'
+        assert course.has_TA(ta), 'Migrated join not found by key'
+        assert client.get(model.join_key(
+            client, 'tas', course_id=course.get_id(), ta_id=ta.get_id())) is not None
+        assert migrations.migrate_join_keys(client)['tas'] == 0, 'Migration is not idempotent'
+
+
+def test_repeat_sign_in_is_refused(monkeypatch):
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        ta = context['ta']
+        course.add_student(student)
+        course.add_student(ta)
+        secret = course.open_session()
+        window_id = course.get_open_session().key.id
+
+        assert student.sign_in(course, secret), 'Sign-in failed'
+        with pytest.raises(ValueError):
+            student.sign_in(course, secret)
+        assert course.attendance_record_key(window_id, student) == model.join_key(
+            course.datastore, 'attendance_record', course_id=course.get_id(),
+            attendance_window_id=window_id, user_id=student.get_id()), 'Record key changed'
+
+        # a record saved under an allocated id before the records had keys
+        legacy = datastore.Entity(key=course.datastore.key('attendance_record'))
+        legacy.update(course_id=course.get_id(), attendance_window_id=window_id,
+                      user_id=ta.get_id())
+        course.datastore.put(legacy)
+        assert course.currently_signed_in(ta), 'Legacy record was not seen'
+        with pytest.raises(ValueError):
+            ta.sign_in(course, secret)
+        assert len(course.get_attendance_records(student=ta)) == 1, 'TA signed in twice'
+
+        monkeypatch.setattr(config, 'LEGACY_JOINS', False)
+        assert not course.currently_signed_in(ta), 'Legacy records looked up after migration'
+        course.close_session()
+
+
+def test_attendance_counters():
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        ta = context['ta']
+        course.add_student(student)
+        course.add_student(ta)
+        add_attendance_records(course, [student, ta], 2)
+
+        assert course.session_count() == 2, (
+            'Session counter is {}'.format(course.session_count()))
+        assert course.attendance_count() == 4, (
+            'Attendance counter is {}'.format(course.attendance_count()))
+        assert course.attendance_count(student) == 2, (
+            'Student attendance counter is {}'.format(course.attendance_count(student)))
+
+        session_id = course.get_sessions()[0].key.id
+        course.edit_attendance_history(student=student, session_id=session_id, attended=False)
+        assert course.attendance_count(student) == 1, (
+            'Student attendance counter is {} after edit'.format(
+                course.attendance_count(student)))
+
+        course.remove_student(ta)
+        assert course.attendance_count() == 1, (
+            'Attendance counter is {} after removing a student'.format(
+                course.attendance_count()))
+        assert course.attendance_count(ta) == 0, (
+            'Removed student still counted {} times'.format(course.attendance_count(ta)))
+
+
+def test_uncounted_course_is_recounted_on_read():
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        ta = context['ta']
+        course.add_student(student)
+        course.add_student(ta)
+        add_attendance_records(course, [student], 2)
+
+        # a course from before the counters has no shards at all
+        query = course.datastore.query(kind='counter_shard')
+        query.add_filter('course_id', '=', course.get_id())
+        query.keys_only()
+        course.datastore.delete_multi([shard.key for shard in query.fetch()])
+
+        assert course.attendance_counts([student, ta]) == {
+            student.get_id(): 2, ta.get_id(): 0}, (
+            'Attendance counts are {}'.format(course.attendance_counts([student, ta])))
+        assert course.session_count() == 2, (
+            'Session counter is {}'.format(course.session_count()))
+        assert course.attendance_count() == 2, (
+            'Attendance counter is {}'.format(course.attendance_count()))
+
+        new_course = context['teacher'].add_course('Course 2')
+        try:
+            assert new_course.session_count() == 0, 'New course has sessions'
+            assert new_course._counted_marker().value(default=None) == 0, (
+                'New course was not marked as counted')
+        finally:
+            new_course.destroy()
+
+
+def test_uncounted_course_is_recounted_after_writes():
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        course.add_student(student)
+        add_attendance_records(course, [student], 3)
+
+        query = course.datastore.query(kind='counter_shard')
+        query.add_filter('course_id', '=', course.get_id())
+        query.keys_only()
+        course.datastore.delete_multi([shard.key for shard in query.fetch()])
+
+        # the first writes after the counters arrive increment them from nothing
+        add_attendance_records(course, [student], 1)
+        assert course.session_count() == 4, (
+            'Session counter is {}'.format(course.session_count()))
+        assert course.attendance_count(student) == 4, (
+            'Student attendance counter is {}'.format(course.attendance_count(student)))
+        assert course.attendance_count() == 4, (
+            'Attendance counter is {}'.format(course.attendance_count()))
+
+
+def test_memory_backend_pages_queries_and_detects_collisions():
+    client = memory_backend.Client('memory-backend-test')
+    memory_backend.get_store('memory-backend-test').clear()
+    for number in range(5):
+        entity = datastore.Entity(key=client.key('row'))
+        entity.update({'course_id': 1, 'number': 4 - number})
+        client.put(entity)
+
+    seen = []
+    cursor = None
+    while True:
+        query = client.query(kind='row')
+        query.add_filter('course_id', '=', 1)
+        query.order = ['number']
+        results = query.fetch(limit=2, start_cursor=cursor)
+        rows = list(results)
+        seen.extend(row['number'] for row in rows)
+        # deleting what was read must not shift the next page
+        client.delete_multi([row.key for row in rows])
+        if results.next_page_token is None:
+            break
+        cursor = results.next_page_token
+    assert seen == [0, 1, 2, 3, 4], 'Paged query returned {}'.format(seen)
+
+    key = client.key('row', 'counter')
+    client.put(datastore.Entity(key=key))
+    with pytest.raises(Conflict):
+        with client.transaction():
+            client.get(key)
+            other = memory_backend.Client('memory-backend-test')
+            other.put(datastore.Entity(key=key))
+            client.put(datastore.Entity(key=key))
+
+
+def test_sql_backend_joins(tmpdir):
+    client = sql_backend.Client('sql-backend-test', str(tmpdir.join('imhere.sqlite3')))
+    student = datastore.Entity(key=client.key('user'))
+    student.update({'name': 'Student', 'uni': 'st1234'})
+    client.put(student)
+    take = datastore.Entity(key=client.key('takes', '1:{}'.format(student.key.id)))
+    take.update({'course_id': 1, 'student_id': student.key.id})
+    client.put(take)
+
+    windows = []
+    for hour in range(3):
+        window = datastore.Entity(key=client.key('attendance_window'))
+        window.update({'course_id': 1, 'opened_at': datetime(2017, 9, 1, hour),
+                       'closed_at': datetime(2017, 9, 1, hour, 30), 'secret': 1234})
+        client.put(window)
+        windows.append(window)
+    # one record under its join key, two more under allocated ids from before
+    for key in [client.key('attendance_record', 'r'), client.key('attendance_record'),
+                client.key('attendance_record')]:
+        record = datastore.Entity(key=key)
+        record.update({'course_id': 1, 'attendance_window_id': windows[1].key.id,
+                       'user_id': student.key.id})
+        client.put(record)
+    record = datastore.Entity(key=client.key('attendance_record'))
+    record.update({'course_id': 1, 'attendance_window_id': windows[2].key.id,
+                   'user_id': student.key.id})
+    client.put(record)
+    legacy = datastore.Entity(key=client.key('takes'))
+    legacy.update({'course_id': 1, 'student_id': student.key.id})
+    client.put(legacy)
+
+    members = client.get_members(1, 'takes')
+    assert [member['uni'] for member in members] == ['st1234'], (
+        'Course members are {}'.format(members))
+    details = client.get_attendance_details(1, student.key.id)
+    assert [detail['attended'] for detail in details] == [False, True, True], (
+        'Attendance details are {}'.format(details))
+
+
+def test_instrumentation_counts_calls_and_enforces_budget():
+    client = instrumentation.InstrumentedClient(memory_backend.Client('instrumentation-test'))
+    key = client.key('user', 1)
+    with flask.Flask(__name__).app_context():
+        stats = instrumentation.start(budget=3)
+        client.put(datastore.Entity(key=key))
+        client.get(key)
+        query = client.query(kind='user')
+        query.add_filter('uni', '=', 'ab1234')
+        list(query.fetch())
+        assert stats.counts['put'] == 1 and stats.counts['get'] == 1, (
+            'Recorded {}'.format(stats.summary()))
+        assert stats.counts['query'] == 1, 'Recorded {}'.format(stats.summary())
+
+        with pytest.raises(instrumentation.RpcBudgetExceeded):
+            client.get(key)
+
+    endpoints = instrumentation.EndpointStats(window=2)
+    for latency in (0.1, 0.2, 0.3):
+        endpoints.add('home', latency, stats)
+    summary = endpoints.summary()['home']
+    assert summary['requests'] == 2, 'Window kept {} requests'.format(summary['requests'])
+    assert summary['latency_ms']['p99'] == 300.0, 'p99 is {}'.format(summary['latency_ms'])
+
+
+def test_home_view_model():
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        teacher = context['teacher']
+        course.add_student(student)
+        secret = course.open_session()
+        student.sign_in(course, secret)
+
+        home = view_models.build_home({'teacher': teacher})
+        assert home['taken'] is None, 'Teacher has taken courses {}'.format(home['taken'])
+        assert [row['secret'] for row in home['taught']] == [secret], (
+            'Taught courses are {}'.format(home['taught']))
+
+        home = view_models.build_home({'student': student, 'ta': student.as_TA()})
+        assert home['taught'] is None, 'Student has taught courses {}'.format(home['taught'])
+        assert home['taed'] == [], 'Student TAs {}'.format(home['taed'])
+        assert [(row['id'], row['signed_in']) for row in home['taken']] == [
+            (course.get_id(), True)], 'Taken courses are {}'.format(home['taken'])
+
+        # a TA signed in before records had keys
+        ta = context['ta']
+        course.add_TA(ta)
+        record = datastore.Entity(key=course.datastore.key('attendance_record'))
+        record.update(course_id=course.get_id(), user_id=ta.get_id(),
+                      attendance_window_id=course.get_open_session().key.id)
+        course.datastore.put(record)
+        home = view_models.build_home({'student': ta, 'ta': ta.as_TA()})
+        assert [(row['id'], row['signed_in']) for row in home['taed']] == [
+            (course.get_id(), True)], 'TA courses are {}'.format(home['taed'])
+        course.close_session()
+
+
+def test_principal_cached_in_session():
+    with common_context() as context:
+        teacher = context['teacher']
+        session = {'user_id': teacher.get_id()}
+        cached = principal.load(session, clock=lambda: 1000.0)
+        assert cached['teacher'] and cached['uni'] is None, 'Principal is {}'.format(cached)
+
+        models = principal.user_models(cached)
+        assert sorted(models) == ['teacher', 'user'], 'Teacher has models {}'.format(models)
+        assert models['teacher'].teaches_course(context['course']), 'Lazy teacher is wrong'
+
+        session['principal']['name'] = 'Stale Name'
+        assert principal.load(session, clock=lambda: 1001.0)['name'] == 'Stale Name', (
+            'Principal was read again within the TTL')
+        reread = principal.load(session, clock=lambda: 1000.0 + config.PRINCIPAL_TTL)
+        assert reread['name'] == teacher.get('name'), 'Principal was not read again'
+
+        student = context['student']
+        principal.remember(session, student)
+        models = principal.user_models(principal.load(session))
+        assert sorted(models) == ['student', 'ta', 'user'], 'Student has models {}'.format(models)
+
+
+def test_user_indexes():
+    with common_context() as context:
+        student = context['student']
+        client = student.datastore
+        assert users_model.find_ids_by_uni(client, ['student1', 'nobody']) == {
+            'student1': student.get_id()}, 'UNI index is wrong'
+        assert students_model.Student(email=student.get('email')).get_id() == student.get_id(), (
+            'Email index is wrong')
+
+        with pytest.raises(students_model.DuplicateUNIException):
+            context['ta'].register_as_student(uni='student1')
+
+        student.register_as_student(uni='student4')
+        assert users_model.find_ids_by_uni(client, ['student1', 'student4']) == {
+            'student4': student.get_id()}, 'Old UNI still points at the student'
+        assert not client.get(users_model.index_key(client, 'uni', 'student1')), (
+            'Old UNI index entity was kept')
+
+
+def test_unindexed_users(monkeypatch):
+    ids = list()
+
+    def legacy_user(**properties):
+        # saved before the indexes existed, so it has no index entities
+        user = datastore.Entity(key=client.key('user'))
+        user.update(properties)
+        client.put(user)
+        ids.append(user.key.id)
+        return user.key.id
+
+    with common_context() as context:
+        course = context['course']
+        client = course.datastore
+        old = legacy_user(name='Old Student', email='old@cs.columbia.edu', uni='old1')
+        twin = legacy_user(name='Old Twin', email='old@cs.columbia.edu')
+        legacy_user(name='Unseen', email='unseen@cs.columbia.edu', uni='old2')
+        try:
+            assert users_model.find_ids_by_uni(client, ['old1', 'nobody']) == {'old1': old}, (
+                'Unindexed UNI was not found')
+            assert client.get(users_model.index_key(client, 'uni', 'old1'))['user_id'] == old, (
+                'Found UNI was not indexed')
+            assert course.add_students_by_uni(['old1']) == {'old1': courses_model.ADDED}, (
+                'Unindexed student was not enrolled')
+
+            signed_in = users_model.User(email='old@cs.columbia.edu', name='Old').get_or_create()
+            assert signed_in.get_id() == old, 'Sign-in created a second user'
+            query = client.query(kind='user')
+            query.add_filter('email', '=', 'old@cs.columbia.edu')
+            assert len(list(query.fetch())) == 2, 'Sign-in saved another user'
+
+            with pytest.raises(students_model.DuplicateUNIException):
+                students_model.Student(id=twin).register_as_student(uni='old2')
+            with pytest.raises(users_model.DuplicateUserException) as clash:
+                students_model.Student(id=twin).register_as_student(uni='twin1')
+            assert clash.value.field == 'email', 'Clash was on {}'.format(clash.value.field)
+
+            monkeypatch.setattr(config, 'LEGACY_USERS', False)
+            legacy_user(name='Late', uni='old3')
+            assert users_model.find_ids_by_uni(client, ['old3']) == {}, (
+                'Unindexed users looked for after the migration')
+        finally:
+            for id in ids:
+                users_model.User(id=id).destroy()
+
+
+def test_lazy_models_load_together():
+    with common_context() as context:
+        with flask.Flask(__name__).app_context():
+            stats = instrumentation.start()
+            course = courses_model.Course(id=context['course'].get_id())
+            student = students_model.Student(id=context['student'].get_id())
+            missing = courses_model.Course(id=-1)
+            assert course.get_id() == context['course'].get_id(), 'Lazy course has the wrong id'
+            assert stats.counts['get'] == 0, 'Building lazy models made {}'.format(stats.summary())
+
+            assert student.fetched and course.get('name') == 'Course 1', 'Lazy models are wrong'
+            assert not missing.fetched, 'Missing course was fetched'
+            assert stats.counts['get'] == 1, 'Loading lazy models made {}'.format(stats.summary())
+
+
+def test_fanout_shares_the_request_context():
+    with common_context() as context:
+        course = context['course']
+        with flask.Flask(__name__).app_context():
+            stats = instrumentation.start()
+            page = view_models.build_course(course)
+            assert page['session'] is None and page['session_count'] == 0, (
+                'Course page is {}'.format(page))
+            assert stats.counts['get'] > 0, 'Reads on the pool were not counted'
+
+            threads = fanout.gather(*[lambda: threading.current_thread().name] * 2)
+            assert threading.current_thread().name not in threads, 'Calls ran inline'
+            teacher_id = context['teacher'].get_id()
+            assert teachers_model.Teacher(id=teacher_id).fetched, 'Teacher was not found'
+            gets = stats.counts['get']
+            found = fanout.gather(*[lambda: teachers_model.Teacher(id=teacher_id).fetched] * 2)
+            assert found == [True, True] and stats.counts['get'] == gets, (
+                'Calls did not share the identity map')
+
+
+def test_attendance_export():
+    with common_context() as context:
+        course = context['course']
+        student = context['student']
+        ta = context['ta']
+        course.add_student(student)
+        course.add_TA(ta)
+        course.add_student(ta)
+        add_attendance_records(course, [student], 2)
+        add_attendance_records(course, [ta], 1)
+
+        rows = list(course.iter_attendance(page_size=1))
+        assert len(rows) == 3 * 3, 'Exported {} rows'.format(len(rows))
+        attended = dict()
+        for row in rows:
+            attended.setdefault((row['uni'], row['role']), []).append(row['attended'])
+        assert attended == {
+            ('student1', 'student'): [True, True, False],
+            ('student2', 'student'): [False, False, True],
+            ('student2', 'TA'): [False, False, True]
+        }, 'Exported attendance is {}'.format(attended)
+
+        lines = ''.join(exports.to_csv(rows, ['uni', 'role', 'attended'])).splitlines()
+        assert lines[0] == 'uni,role,attended' and len(lines) == 10, 'CSV is {}'.format(lines)
+        jsonl = ''.join(exports.to_jsonl(rows[:1])).splitlines()
+        assert json.loads(jsonl[0])['session_id'] == rows[0]['session_id'], 'JSONL is wrong'